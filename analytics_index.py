@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+# Предрасчёт по данным: сводки по числовым колонкам, агрегаты по группам и отсортированные индексы метрик.
+# Строится один раз после загрузки данных; top-K и перцентили после этого считаются за O(K) / O(1).
+# Если в df.csv только дописаны строки, индекс обновляется по новым строкам (см. append).
+
+GROUP_COLUMNS = ["City", "Zip", "Neighborhood", "County", "Property Type"]
+RANKED_COLUMNS = ["Price", "Cap rate", "CoC", "NOI (monthly)", "Gross yield", "HOA fee"]
+LISTING_COLUMNS = ["Property ID", "Address", "City", "Property Type"]
+
+
+def _sorted_positions(values, offset=0):
+    valid = np.flatnonzero(~np.isnan(values))
+    order = np.argsort(values[valid], kind="stable")
+    positions = valid[order] + offset
+    return positions, values[valid][order]
+
+
+class AnalyticsIndex:
+    def __init__(self, df, numeric, group_columns=GROUP_COLUMNS, ranked_columns=RANKED_COLUMNS, _state=None):
+        self.df = df
+        self.numeric = [col for col in numeric if col in df.columns]
+        self.group_columns = [col for col in group_columns if col in df.columns]
+        self.ranked_columns = [col for col in ranked_columns if col in df.columns]
+        if _state is not None:
+            self.summaries, self.group_sums, self.sorted = _state
+            return
+
+        self.summaries = self._describe(df)
+        # Для групп храним count, sum, min, max; среднее считается из sum / count
+        self.group_sums = {col: self._group_stats(df, col) for col in self.group_columns}
+        # metric -> (позиции строк по возрастанию метрики, отсортированные значения), NaN исключены
+        self.sorted = {
+            col: _sorted_positions(df[col].to_numpy(dtype=float, na_value=np.nan)) for col in self.ranked_columns
+        }
+
+    def _describe(self, df):
+        return df[self.numeric].describe() if self.numeric else pd.DataFrame()
+
+    def _group_stats(self, df, group):
+        stats = df.groupby(group, observed=True)[self.ranked_columns].agg(["count", "sum", "min", "max"])
+        stats.index = stats.index.astype(str)
+        return stats
+
+    def summary(self, col):
+        return self.summaries[col]
+
+    def top_k(self, metric, k=5, ascending=False, columns=None):
+        positions, _ = self.sorted[metric]
+        selected = positions[:k] if ascending else positions[::-1][:k]
+        columns = columns or [col for col in LISTING_COLUMNS if col in self.df.columns]
+        return self.df.iloc[selected][columns + [metric]]
+
+    def percentile(self, metric, q):
+        # q в процентах; линейная интерполяция, как у np.percentile
+        if not 0 <= q <= 100:
+            raise ValueError(f"q must be between 0 and 100, got {q}")
+        _, values = self.sorted[metric]
+        if len(values) == 0:
+            return np.nan
+        position = (len(values) - 1) * q / 100.0
+        lower = int(np.floor(position))
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def group_summary(self, group, metric):
+        stats = self.group_sums[group][metric]
+        result = pd.DataFrame({
+            "count": stats["count"],
+            "mean": stats["sum"] / stats["count"].replace(0, np.nan),
+            "min": stats["min"],
+            "max": stats["max"],
+        })
+        return result[result["count"] > 0]
+
+    def _same_prefix(self, df):
+        # Первые len(self.df) строк нового фрейма совпадают со старыми во всех колонках, от которых зависит индекс
+        offset = len(self.df)
+        for col in self.ranked_columns:
+            old = self.df[col].to_numpy(dtype=float, na_value=np.nan)
+            new = df[col].iloc[:offset].to_numpy(dtype=float, na_value=np.nan)
+            if not np.array_equal(old, new, equal_nan=True):
+                return False
+        for col in self.group_columns:
+            old = self.df[col].astype(str).to_numpy()
+            new = df[col].iloc[:offset].astype(str).to_numpy()
+            if not np.array_equal(old, new):
+                return False
+        return True
+
+    def append(self, df):
+        # Инкрементальное обновление, когда df - прежний фрейм с дописанными в конец строками: в отсортированные
+        # массивы вставляются только новые значения, групповые агрегаты складываются. Возвращает новый индекс
+        # (текущий остаётся валидным для тех, кто его читает) или None, если прежние строки изменились
+        offset = len(self.df)
+        columns = self.numeric + self.group_columns + self.ranked_columns
+        if len(df) <= offset or any(col not in df.columns for col in columns) or not self._same_prefix(df):
+            return None
+
+        merged_sorted = {}
+        for col, (positions, values) in self.sorted.items():
+            new_positions, new_values = _sorted_positions(
+                df[col].iloc[offset:].to_numpy(dtype=float, na_value=np.nan), offset
+            )
+            insert_at = np.searchsorted(values, new_values, side="right")
+            merged_sorted[col] = (np.insert(positions, insert_at, new_positions), np.insert(values, insert_at, new_values))
+
+        new_part = df.iloc[offset:]
+        group_sums = {}
+        for col, stats in self.group_sums.items():
+            combined = pd.concat([stats, self._group_stats(new_part, col)])
+            functions = {name: ("sum" if name[1] in ("count", "sum") else name[1]) for name in combined.columns}
+            group_sums[col] = combined.groupby(level=0).agg(functions)
+
+        # Квантили в describe не складываются, поэтому сводки по числовым колонкам пересчитываются целиком
+        summaries = self._describe(df)
+        return AnalyticsIndex(df, self.numeric, self.group_columns, self.ranked_columns,
+                              _state=(summaries, group_sums, merged_sorted))
@@ -1,6 +1,8 @@
+import time
 import streamlit as st
 import pandas as pd
-from openai_client import handle_user_query, load_and_preprocess_data
+from openai_client import pipeline, registry, tracer
+from pipeline import QUERY_TIMEOUT, PipelineBusy
 
 # Заголовок вашего приложения
 st.title('Real Estate Investment Chatbot')
@@ -21,34 +23,73 @@ with st.sidebar:
     st.write("- What are the house prices in area X?")
     st.write("- Plot the price distribution of houses")
 
+    with st.expander("Resource stats"):
+        for name, stats in registry.stats().items():
+            if stats["loaded"]:
+                st.write(f"**{name}**: {stats['memory_bytes'] / 2**20:.1f} MB, built in {stats['build_seconds']:.2f} s (builds: {stats['builds']}, incremental: {stats['refreshes']})")
 
-# Загрузка и предобработка данных
-file_path = 'df.csv'
-df, _, _, _, _, _, _ = load_and_preprocess_data(file_path)
+    with st.expander("Latency by route"):
+        for route, stats in tracer.stats().items():
+            total = stats["spans"].get("total", {})
+            if total:
+                st.write(f"**{route}**: {total['count']} requests, p50 {total['p50_ms']:.0f} ms, p95 {total['p95_ms']:.0f} ms, cost ${stats.get('cost_usd', 0):.4f}")
+
+
+# Данные общие для всех сессий процесса: при повторных запусках скрипта берутся из реестра, а не загружаются заново
+df = registry.get("dataset").df
 
 # Инициализация состояния сессии
 if "chat_history" not in st.session_state:
     st.session_state["chat_history"] = []
 
-if "plot_data" not in st.session_state:
-    st.session_state["plot_data"] = []
-
 # Отображение истории чата
-if st.session_state["chat_history"]:
-    st.write("## Chat History")
-    for i, message in enumerate(st.session_state["chat_history"]):
-        role = "User" if message["role"] == "user" else "Bot"
-        st.write(f"**{role}:** {message['content']}")
-        if role == "Bot" and len(st.session_state["plot_data"]) > i // 2:
-            st.image(st.session_state["plot_data"][i // 2])
-
-# Форма для ввода пользовательского сообщения внизу страницы
-user_message = st.text_input("Enter your message:", key="user_message_input_new")
-
-if st.button("Send") and user_message:
-    response, plot_path = handle_user_query(user_message)
+for message in st.session_state["chat_history"]:
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        if message.get("plot") is not None:
+            st.image(message["plot"])
+
+# Поле ввода внизу страницы; ответ выводится по мере генерации, без перезагрузки страницы
+if user_message := st.chat_input("Enter your message:"):
     st.session_state["chat_history"].append({"role": "user", "content": user_message})
-    st.session_state["chat_history"].append({"role": "assistant", "content": response})
-    if plot_path:
-        st.session_state["plot_data"].append(plot_path)
-    st.experimental_rerun()  # Перезагрузка страницы для обновления контента
+    with st.chat_message("user"):
+        st.markdown(user_message)
+
+    with st.chat_message("assistant"):
+        status = st.status("Thinking...", expanded=False)
+        placeholder = st.empty()
+        response, plot = None, None
+        # Трасса запроса создаётся здесь, чтобы в неё попало и время вывода ответа на страницу
+        trace = tracer.start_trace()
+        try:
+            stream = pipeline.submit(user_message, trace=trace)
+        except PipelineBusy as e:
+            stream, response = None, str(e)
+            trace.route = "busy"
+
+        streamed_text = ""
+        render_started = None
+        for kind, payload in stream.events(timeout=QUERY_TIMEOUT) if stream else []:
+            if kind == "token":
+                streamed_text += payload
+                placeholder.markdown(streamed_text + "▌")
+            elif kind == "step":
+                # Новый шаг агента: предыдущие токены были промежуточными
+                streamed_text = ""
+                status.write(payload)
+            elif kind == "result":
+                response, plot = payload
+                render_started = time.time(), time.perf_counter()
+            elif kind == "error":
+                response = f"An error occurred: {payload}"
+            elif kind == "timeout":
+                response = "The request took too long and was cancelled. Please try again or rephrase it."
+
+        status.update(label="Done", state="complete")
+        placeholder.markdown(response)
+        if plot is not None:
+            st.image(plot)
+        if render_started is not None:
+            trace.add_span("streamlit_render", render_started[0], (time.perf_counter() - render_started[1]) * 1000)
+        trace.finish()
+    st.session_state["chat_history"].append({"role": "assistant", "content": response, "plot": plot})
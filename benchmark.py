@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mlflow
+import numpy as np
+import pandas as pd
+from mlflow import MlflowClient
+
+from fake_openai_server import start_server
+
+# Воспроизводимый бенчмарк handle_user_query: синтетический df.csv заданного размера, локальный сервер,
+# проигрывающий ответы агента, холодный старт, задержки по маршрутам, пропускная способность и пиковая память.
+# Результаты пишутся в MLflow (эксперимент "benchmark") с хэшем коммита, чтобы сравнивать их между коммитами.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CITIES = {
+    "Austin": ("Travis", ["78701", "78702", "78703", "78704"]),
+    "Dallas": ("Dallas", ["75201", "75202", "75204"]),
+    "Houston": ("Harris", ["77002", "77003", "77004", "77005"]),
+    "San Antonio": ("Bexar", ["78205", "78207"]),
+    "El Paso": ("El Paso", ["79901", "79902"]),
+}
+PROPERTY_TYPES = ["Single Family", "Condo", "Townhouse", "Multi Family"]
+DESCRIPTION_PHRASES = [
+    "Beautifully renovated kitchen", "Close to the airport", "Quiet street", "Large backyard",
+    "Walking distance to schools", "New roof", "Needs some work", "Open floor plan", "Mountain views",
+]
+
+# Генератор работает в отдельном процессе, чтобы его память не попадала в пиковый RSS бенчмарка
+GENERATE_SCRIPT = """
+import sys
+sys.path.insert(0, {repo!r})
+from benchmark import generate_listings_csv
+generate_listings_csv({path!r}, {rows}, {seed})
+"""
+
+COLD_START_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {repo!r})
+import openai_client
+imported = time.perf_counter()
+openai_client.registry.get("dataset")
+loaded = time.perf_counter()
+openai_client.registry.get("faq")
+openai_client.registry.get("query_engine")
+ready = time.perf_counter()
+peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024) / 2**20
+print(json.dumps({{"import_s": imported - started, "dataset_s": loaded - imported, "ready_s": ready - started,
+                  "peak_rss_mb": peak_rss_mb}}))
+"""
+
+
+def _categories(name, size):
+    return [f"{name} {k}" for k in range(size)]
+
+
+def generate_listings_csv(path, rows, seed=0, chunk_size=100_000):
+    # Схема как у выгрузки Redfin: имена колонок до переименования в load_and_preprocess_data
+    from openai_client import bool_cols, categorial, dates, numeric, rename_dict
+
+    raw_names = {new: old for old, new in rename_dict.items()}
+    derived = {"Age", "Has pool", "Has garage"}
+    rng = np.random.default_rng(seed)
+    city_names = list(CITIES)
+    written = 0
+    while written < rows:
+        n = min(chunk_size, rows - written)
+        ids = np.arange(written, written + n)
+        city_codes = rng.integers(0, len(city_names), n)
+        columns = {}
+        for col in categorial:
+            columns[col] = pd.Categorical.from_codes(rng.integers(0, 200, n), categories=_categories(col, 200))
+        columns["Property ID"] = pd.Series(ids).map("P{:08d}".format)
+        columns["Address"] = pd.Series(ids).map("{} Main St".format)
+        columns["City"] = pd.Categorical.from_codes(city_codes, categories=city_names)
+        columns["County"] = pd.Categorical([CITIES[city_names[c]][0] for c in range(len(city_names))])[city_codes]
+        columns["Zip"] = [CITIES[city_names[c]][1][z % len(CITIES[city_names[c]][1])] for c, z in zip(city_codes, rng.integers(0, 4, n))]
+        columns["State"] = "TX"
+        columns["Neighborhood"] = pd.Categorical.from_codes(rng.integers(0, 300, n), categories=_categories("Neighborhood", 300))
+        columns["Property Type"] = pd.Categorical.from_codes(rng.integers(0, len(PROPERTY_TYPES), n), categories=PROPERTY_TYPES)
+        columns["Pool"] = np.where(rng.random(n) < 0.3, "Yes", None)
+        columns["Description"] = [". ".join(random.Random(int(i) + seed).sample(DESCRIPTION_PHRASES, 3)) for i in ids]
+        for col in numeric:
+            if col not in derived:
+                columns[col] = rng.normal(100, 30, n).round(2)
+        price = rng.lognormal(12.8, 0.5, n).round(-3)
+        rent = (price * rng.uniform(0.004, 0.009, n)).round()
+        columns.update({
+            "Price": price,
+            "Rent estimate": rent,
+            "Year Built": rng.integers(1900, 2024, n).astype(float),
+            "Garage": np.where(rng.random(n) < 0.6, rng.integers(1, 4, n), np.nan),
+            "HOA fee": np.where(rng.random(n) < 0.4, rng.uniform(50, 600, n).round(), np.nan),
+            "Cap rate": rng.normal(5, 2, n).round(2),
+            "CoC": rng.normal(4, 5, n).round(2),
+            "NOI (monthly)": (rent * rng.uniform(0.5, 0.8, n)).round(),
+            "Gross yield": (rent * 12 / price * 100).round(2),
+        })
+        for col in dates:
+            columns[col] = (pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1500, n), unit="D")).strftime("%Y-%m-%d")
+        for col in bool_cols:
+            if col not in derived:
+                columns[col] = pd.array(np.where(rng.random(n) < 0.1, True, False), dtype="boolean")
+        chunk = pd.DataFrame(columns).rename(columns=raw_names)
+        chunk.to_csv(path, mode="w" if written == 0 else "a", header=written == 0, index=False)
+        written += n
+
+
+def load_corpus(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def measure_cold_start(workdir, env):
+    # Два свежих процесса: без кэша данных (разбор CSV) и с готовым Feather-кэшем
+    results = {}
+    shutil.rmtree(os.path.join(workdir, ".cache"), ignore_errors=True)
+    for label in ("cold", "warm"):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT.format(repo=REPO_DIR)],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True,
+        )
+        timings = json.loads(output.stdout.strip().splitlines()[-1])
+        results.update({f"{label}_{key}": value for key, value in timings.items()})
+    return results
+
+
+def timed_query(pipeline, query, timeout):
+    started = time.perf_counter()
+    first_event = None
+    outcome = None
+    for kind, payload in pipeline.submit(query).events(timeout=timeout):
+        if first_event is None:
+            first_event = time.perf_counter() - started
+        if kind in ("result", "error", "timeout"):
+            outcome = kind
+    return {"latency": time.perf_counter() - started, "ttfb": first_event, "outcome": outcome}
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {}
+    return {
+        "count": int(len(values)),
+        "p50_ms": float(np.percentile(values, 50) * 1000),
+        "p95_ms": float(np.percentile(values, 95) * 1000),
+        "p99_ms": float(np.percentile(values, 99) * 1000),
+    }
+
+
+def clear_caches(client):
+    client.response_cache.clear()
+    if client.registry.stats()["plot_renderer"]["loaded"]:
+        client.registry.get("plot_renderer").clear()
+
+
+def run_routes(client, corpus, repeat, timeout, warm_caches):
+    # Последовательный прогон: задержка и время до первого события по каждому маршруту
+    by_route = {}
+    for _ in range(repeat):
+        for entry in corpus:
+            if not warm_caches:
+                clear_caches(client)
+            result = timed_query(client.pipeline, entry["query"], timeout)
+            by_route.setdefault(entry["route"], []).append(result)
+    return {
+        route: {
+            **percentiles([r["latency"] for r in results]),
+            "ttfb_p50_ms": float(np.percentile([r["ttfb"] for r in results], 50) * 1000),
+            "errors": sum(r["outcome"] != "result" for r in results),
+        }
+        for route, results in by_route.items()
+    }
+
+
+def run_sessions(client, corpus, sessions, repeat, timeout, seed):
+    # N одновременных сессий, каждая проигрывает корпус в своём порядке
+    def session(number):
+        order = [entry for _ in range(repeat) for entry in corpus]
+        random.Random(seed + number).shuffle(order)
+        return [timed_query(client.pipeline, entry["query"], timeout) for entry in order]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = [r for session_results in executor.map(session, range(sessions)) for r in session_results]
+    elapsed = time.perf_counter() - started
+    return {
+        "sessions": sessions,
+        "queries": len(results),
+        "throughput_qps": len(results) / elapsed,
+        **percentiles([r["latency"] for r in results]),
+        "errors": sum(r["outcome"] != "result" for r in results),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss: килобайты в Linux, байты в macOS. Это максимум за жизнь процесса, поэтому в нём не должно
+    # быть ничего, кроме самого бота: CSV генерируется и холодный старт меряется в дочерних процессах
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def csv_rows(path):
+    # Число строк данных без разбора CSV (в синтетических описаниях нет переводов строк)
+    lines = 0
+    with open(path, "rb") as file:
+        while block := file.read(2**20):
+            lines += block.count(b"\n")
+    return lines - 1
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def log_to_mlflow(tracking_uri, experiment_name, args, results):
+    client = MlflowClient(tracking_uri=tracking_uri)
+    experiment = client.get_experiment_by_name(experiment_name)
+    experiment_id = experiment.experiment_id if experiment else client.create_experiment(experiment_name)
+    commit, dirty = git_commit()
+    run = client.create_run(experiment_id, tags={"git_commit": commit, "git_dirty": str(dirty)},
+                            run_name=f"{commit[:8]}-{args.rows}rows-{args.sessions}sessions")
+    params = {"rows": args.rows, "sessions": args.sessions, "repeat": args.repeat, "latency": args.latency,
+              "token_delay": args.token_delay, "warm_caches": args.warm_caches, "seed": args.seed}
+    for key, value in params.items():
+        client.log_param(run.info.run_id, key, value)
+    metrics = {f"start_{key}": value for key, value in results["start"].items()}
+    for route, stats in results["routes"].items():
+        metrics.update({f"{route}_{key}": value for key, value in stats.items()})
+    metrics.update({f"concurrent_{key}": value for key, value in results["concurrent"].items()})
+    metrics.update({"peak_rss_mb": results["peak_rss_mb"], "fast_path_hit_rate": results["fast_path_hit_rate"]})
+    for key, value in metrics.items():
+        client.log_metric(run.info.run_id, key, float(value))
+    client.set_terminated(run.info.run_id)
+    return run.info.run_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handle_user_query against a local OpenAI stand-in")
+    parser.add_argument("--rows", type=int, default=10_000, help="rows in the synthetic listings CSV (10k-1M)")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent chat sessions")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the corpus")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency per call, seconds")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="delay between streamed chunks, seconds")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-query timeout, seconds")
+    parser.add_argument("--corpus", default=os.path.join(REPO_DIR, "benchmark_corpus.json"))
+    parser.add_argument("--workdir", help="directory for df.csv and caches (default: a temporary directory)")
+    parser.add_argument("--warm-caches", action="store_true", help="keep response and plot caches between queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--experiment", default="benchmark", help="MLflow experiment for the results")
+    parser.add_argument("--no-mlflow", action="store_true")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    # Результаты - в трекинг-сервер пользователя; запуски самих запросов - в отдельный каталог рядом с данными
+    results_uri = mlflow.get_tracking_uri()
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="chatbot-benchmark-"))
+    os.makedirs(workdir, exist_ok=True)
+    corpus = load_corpus(args.corpus)
+
+    server = start_server(corpus, latency=args.latency, token_delay=args.token_delay)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_BASE": base_url,
+        "MLFLOW_TRACKING_URI": "file:" + os.path.join(workdir, "mlruns"),
+        "RESPONSE_CACHE_DB": os.path.join(workdir, "responses.sqlite"),
+    })
+    os.chdir(workdir)
+
+    csv_path = os.path.join(workdir, "df.csv")
+    if not os.path.exists(csv_path) or csv_rows(csv_path) != args.rows:
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", GENERATE_SCRIPT.format(repo=REPO_DIR, path=csv_path, rows=args.rows, seed=args.seed)],
+            cwd=workdir, check=True,
+        )
+        print(f"Generated {args.rows} rows in {time.perf_counter() - started:.1f} s: {csv_path}")
+
+    results = {"start": measure_cold_start(workdir, dict(os.environ))}
+    print(f"Cold start: {results['start']}")
+
+    import openai_client
+    from query_engine import fast_path_stats
+
+    openai_client.registry.get("query_engine")
+    results["routes"] = run_routes(openai_client, corpus, args.repeat, args.timeout, args.warm_caches)
+    results["concurrent"] = run_sessions(openai_client, corpus, args.sessions, args.repeat, args.timeout, args.seed)
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["fast_path_hit_rate"] = fast_path_stats()["hit_rate"]
+    results["llm_requests"] = server.script.requests
+    openai_client.tracer.flush()
+    results["spans"] = openai_client.tracer.stats()
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if not args.no_mlflow:
+        run_id = log_to_mlflow(results_uri, args.experiment, args, results)
+        print(f"Logged MLflow run {run_id} to {results_uri}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import shutil
+from datetime import date
+
+import pandas as pd
+import pyarrow.feather as feather
+
+# Каталог для кэша предобработанных данных
+CACHE_DIR = ".cache"
+CACHE_FORMAT_VERSION = 1
+
+# Строковые колонки с долей уникальных значений ниже порога хранятся как category
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def read_csv_header(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+        return file.readline().strip()
+
+
+def file_fingerprint(file_path, variant=""):
+    # Ключ кэша: путь, размер, время изменения и схема (заголовок CSV); variant - способ загрузки, если не обычный.
+    # Текущий год тоже входит в ключ: колонка Age считается от него и иначе устаревала бы в новом году
+    stat = os.stat(file_path)
+    parts = [
+        os.path.abspath(file_path),
+        str(stat.st_size),
+        str(stat.st_mtime_ns),
+        read_csv_header(file_path),
+        str(CACHE_FORMAT_VERSION),
+        str(date.today().year),
+    ] + ([variant] if variant else [])
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def file_content_hash(file_path, block_size=1 << 20):
+    # Хэш содержимого файла: версия данных для кэшей, которые должны сбрасываться при любом изменении
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def to_categoricals(df, columns):
+    for col in columns:
+        if col not in df.columns or df[col].dtype != object:
+            continue
+        if df[col].nunique(dropna=False) <= CATEGORY_MAX_UNIQUE_RATIO * max(len(df), 1):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def cache_paths(file_path, cache_dir=CACHE_DIR, variant=""):
+    key = file_fingerprint(file_path, variant)
+    base = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(file_path))[0]}-{key}")
+    return base + ".feather", base + ".json"
+
+
+def column_store_path(file_path, cache_dir=CACHE_DIR, variant=""):
+    # Каталог Parquet-набора с полными данными (режим spill), рядом с Feather-кэшем той же версии
+    return os.path.splitext(cache_paths(file_path, cache_dir, variant)[0])[0] + ".parquet"
+
+
+def cached_frame_path(file_path, cache_dir=CACHE_DIR, variant=""):
+    # Путь к актуальному Feather-файлу, если кэш уже записан
+    data_path, meta_path = cache_paths(file_path, cache_dir, variant)
+    return data_path if os.path.exists(data_path) and os.path.exists(meta_path) else None
+
+
+def _read_cache(data_path, meta_path):
+    with open(meta_path, "r", encoding="utf-8") as file:
+        meta = json.load(file)
+    # memory_map: файл отображается в память, без разбора CSV
+    df = feather.read_table(data_path, memory_map=True).to_pandas()
+    column_types = pd.Series({name: dtype for name, dtype in zip(meta["column_names"], meta["column_types"])})
+    return (df, pd.Index(meta["column_names"]), column_types, meta["numeric"],
+            meta["categorial"], meta["dates"], meta["bool_cols"])
+
+
+def _write_cache(data_path, meta_path, result):
+    df, column_names, column_types, numeric, categorial, dates, bool_cols = result
+    os.makedirs(os.path.dirname(data_path) or ".", exist_ok=True)
+    meta = {
+        "column_names": list(column_names),
+        "column_types": [str(column_types[name]) for name in column_names],
+        "numeric": numeric,
+        "categorial": categorial,
+        "dates": dates,
+        "bool_cols": bool_cols,
+    }
+    # Пишем во временные файлы и переименовываем, чтобы параллельный процесс не прочитал половину
+    tmp_data, tmp_meta = data_path + ".tmp", meta_path + ".tmp"
+    feather.write_feather(df, tmp_data, compression="uncompressed")
+    with open(tmp_meta, "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+    os.replace(tmp_data, data_path)
+    os.replace(tmp_meta, meta_path)
+
+
+def _remove_stale(file_path, cache_dir, keep):
+    prefix = os.path.splitext(os.path.basename(file_path))[0] + "-"
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and path not in keep:
+            try:
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            except OSError:
+                pass
+
+
+def load_cached_data(file_path, preprocess, cache_dir=CACHE_DIR, variant="", extra_paths=()):
+    # Возвращает тот же кортеж, что и preprocess(file_path), но из колоночного кэша, если он актуален.
+    # extra_paths - другие результаты preprocess (например, Parquet-набор): без них кэш считается неполным
+    data_path, meta_path = cache_paths(file_path, cache_dir, variant)
+    if all(os.path.exists(path) for path in (data_path, meta_path, *extra_paths)):
+        try:
+            return _read_cache(data_path, meta_path)
+        except Exception as e:
+            print(f"Failed to read data cache {data_path}: {e}")
+
+    df, column_names, column_types, numeric, categorial, dates, bool_cols = preprocess(file_path)
+    df = to_categoricals(df, categorial)
+    result = (df, column_names, column_types, numeric, categorial, dates, bool_cols)
+    try:
+        _write_cache(data_path, meta_path, result)
+        _remove_stale(file_path, cache_dir, keep={data_path, meta_path, *extra_paths})
+    except Exception as e:
+        # Кэш - только ускорение: при ошибке записи работаем с данными из памяти
+        print(f"Failed to write data cache {data_path}: {e}")
+    return result
@@ -0,0 +1,167 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Локальная замена OpenAI Chat Completions API для бенчмарков: детерминированно проигрывает заранее
+# записанные ответы агента с заданной задержкой. Поддерживает function calling и потоковую выдачу (SSE).
+
+DEFAULT_ANSWER = "I could not find an answer to this question in the data."
+
+
+class ReplayScript:
+    # corpus: [{"query": ..., "steps": [{"function_call": {"name", "arguments"}} | {"content": ...}]}]
+    def __init__(self, corpus, latency=0.0, token_delay=0.0, tokens_per_chunk=4):
+        self.entries = sorted(
+            (entry for entry in corpus if entry.get("steps")), key=lambda entry: len(entry["query"]), reverse=True
+        )
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens_per_chunk = tokens_per_chunk
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def reply(self, messages):
+        # Шаг определяется числом уже выполненных вызовов функций в истории сообщений
+        user_text = next((message.get("content") or "" for message in reversed(messages) if message.get("role") == "user"), "")
+        step = sum(1 for message in messages if message.get("role") in ("function", "tool"))
+        for entry in self.entries:
+            if user_text.rstrip().endswith(entry["query"]):
+                steps = entry["steps"]
+                return steps[min(step, len(steps) - 1)]
+        return {"content": DEFAULT_ANSWER}
+
+    def count(self, messages, reply):
+        prompt = sum(len(str(message.get("content") or "").split()) for message in messages)
+        completion = len(str(reply.get("content") or json.dumps(reply.get("function_call", ""))).split())
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+        return prompt, completion
+
+
+def _chunks(text, size):
+    words = text.split(" ")
+    for start in range(0, len(words), size):
+        piece = " ".join(words[start:start + size])
+        yield piece if start + size >= len(words) else piece + " "
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    script = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "gpt-4-turbo-preview", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        messages = request.get("messages", [])
+        reply = self.script.reply(messages)
+        prompt_tokens, completion_tokens = self.script.count(messages, reply)
+        time.sleep(self.script.latency)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "gpt-4-turbo-preview")
+        finish_reason = "function_call" if "function_call" in reply else "stop"
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": reply.get("content")}
+            if "function_call" in reply:
+                message["function_call"] = reply["function_call"]
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send(delta, finish=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        send({"role": "assistant", "content": "" if "content" in reply else None})
+        if "function_call" in reply:
+            send({"function_call": {"name": reply["function_call"]["name"], "arguments": ""}})
+            send({"function_call": {"arguments": reply["function_call"]["arguments"]}})
+        else:
+            for piece in _chunks(reply.get("content") or "", self.script.tokens_per_chunk):
+                time.sleep(self.script.token_delay)
+                send({"content": piece})
+        send({}, finish_reason)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            # Как у OpenAI: последний чанк без choices, только с usage
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                     "total_tokens": prompt_tokens + completion_tokens}
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def start_server(corpus, host="127.0.0.1", port=0, latency=0.0, token_delay=0.0):
+    # Запускает сервер в фоновом потоке; base_url для клиента - f"http://{host}:{server.server_port}/v1"
+    script = ReplayScript(corpus, latency, token_delay)
+    handler = type("ReplayHandler", (Handler,), {"script": script})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.script = script
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay deterministic OpenAI chat completions")
+    parser.add_argument("--corpus", default="benchmark_corpus.json")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before each response")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    args = parser.parse_args()
+    with open(args.corpus, "r", encoding="utf-8") as file:
+        server = start_server(json.load(file), port=args.port, latency=args.latency, token_delay=args.token_delay)
+    print(f"Serving on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,249 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# Поисковый индекс FAQ: TF-IDF по хэшированным признакам. Словарь не обучается, поэтому записи можно
+# добавлять и удалять без переобучения: храним сырые частоты и документные частоты терминов,
+# а веса IDF пересчитываются из счётчиков. Индекс сохраняется на диск и при старте просто загружается.
+
+N_FEATURES = 2**18
+INDEX_FORMAT_VERSION = 2
+COMPACT_RATIO = 0.25
+
+
+def read_faq_files(faq_dir):
+    # *.json: {"вопрос": "ответ"} или [{"question", "answer", "market", "language"}]; *.csv: те же колонки
+    records = []
+    for path in sorted(glob.glob(os.path.join(faq_dir, "*.json"))):
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        if isinstance(data, dict):
+            data = [{"question": question, "answer": answer} for question, answer in data.items()]
+        records.extend(data)
+    for path in sorted(glob.glob(os.path.join(faq_dir, "*.csv"))):
+        with open(path, "r", encoding="utf-8", newline="") as file:
+            records.extend(csv.DictReader(file))
+    return [record for record in records if record.get("question") and record.get("answer")]
+
+
+def record_key(record):
+    # Одна запись на (вопрос, рынок, язык): одинаковый вопрос для разных рынков - разные записи
+    return record["question"], record.get("market") or "", record.get("language") or ""
+
+
+def _as_key(key):
+    return (key, "", "") if isinstance(key, str) else tuple(key)
+
+
+def faq_fingerprint(faq_data, faq_dir=None):
+    # Версия корпуса: содержимое faq_data плюс размер и время изменения файлов FAQ
+    files = []
+    if faq_dir and os.path.isdir(faq_dir):
+        paths = sorted(glob.glob(os.path.join(faq_dir, "*.json")) + glob.glob(os.path.join(faq_dir, "*.csv")))
+        files = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in paths]
+    payload = json.dumps([faq_data, files, INDEX_FORMAT_VERSION], sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class FAQIndex:
+    def __init__(self, n_features=N_FEATURES):
+        self.n_features = n_features
+        # Та же токенизация, что у TfidfVectorizer по умолчанию, но без словаря
+        self.hasher = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        self.records = []  # {"question", "answer", "market", "language"} или None для удалённых
+        self.rows = {}  # (вопрос, рынок, язык) -> номер строки
+        self.counts = sparse.csr_matrix((0, n_features), dtype=np.float64)
+        self.doc_freq = np.zeros(n_features, dtype=np.int64)
+        self.fingerprint = None
+        self._prepared = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def keys(self):
+        return list(self.rows)
+
+    def add(self, records):
+        # records: словари с question/answer (и необязательными market/language); записи с тем же ключом
+        # заменяются, а из повторов внутри одной пачки остаётся последний
+        records = list({record_key(record): dict(record) for record in records}.values())
+        self.remove([record_key(record) for record in records if record_key(record) in self.rows])
+        if not records:
+            return
+        counts = self.hasher.transform([record["question"] for record in records]).tocsr()
+        start = len(self.records)
+        self.counts = sparse.vstack([self.counts, counts], format="csr")
+        self.doc_freq += np.bincount(counts.indices, minlength=self.n_features)
+        for offset, record in enumerate(records):
+            self.records.append(record)
+            self.rows[record_key(record)] = start + offset
+        self._prepared = None
+
+    def remove(self, keys):
+        # keys: (вопрос, рынок, язык) или просто вопрос - запись без рынка и языка
+        for key in keys:
+            row = self.rows.pop(_as_key(key), None)
+            if row is None:
+                continue
+            self.doc_freq[self.counts.indices[self.counts.indptr[row]:self.counts.indptr[row + 1]]] -= 1
+            self.records[row] = None
+        self._prepared = None
+        if len(self.records) and (len(self.records) - len(self.rows)) / len(self.records) > COMPACT_RATIO:
+            self._compact()
+
+    def _compact(self):
+        alive = [row for row, record in enumerate(self.records) if record is not None]
+        self.counts = self.counts[alive]
+        self.records = [self.records[row] for row in alive]
+        self.rows = {record_key(record): row for row, record in enumerate(self.records)}
+        self._prepared = None
+
+    def _idf(self):
+        # Сглаженный IDF как у TfidfTransformer: ln((1 + n) / (1 + df)) + 1
+        return np.log((1 + len(self.rows)) / (1 + self.doc_freq)) + 1
+
+    def _weigh(self, counts, idf):
+        # TF * IDF с L2-нормировкой строк; работаем прямо с массивами CSR, без промежуточных матриц
+        weighted = sparse.csr_matrix(counts, dtype=np.float64, copy=True)
+        weighted.data *= idf[weighted.indices]
+        row_ids = np.repeat(np.arange(weighted.shape[0]), np.diff(weighted.indptr))
+        norms = np.sqrt(np.bincount(row_ids, weights=weighted.data ** 2, minlength=weighted.shape[0]))
+        norms[norms == 0] = 1
+        weighted.data /= norms[row_ids]
+        weighted.eliminate_zeros()
+        return weighted
+
+    def _prepare(self):
+        # Всё собирается в локальных переменных и публикуется одним присваиванием: параллельный первый
+        # поиск из другого потока видит либо None, либо полностью готовое состояние
+        prepared = self._prepared
+        if prepared is None:
+            idf = self._idf()
+            prepared = (
+                self._weigh(self.counts, idf).T.tocsr(),
+                np.array([record is not None for record in self.records], dtype=bool),
+                np.array([(record or {}).get("market") or "" for record in self.records], dtype=object),
+                np.array([(record or {}).get("language") or "" for record in self.records], dtype=object),
+                np.where(self.doc_freq > 0, idf, 0),  # слова вне корпуса не влияют на запрос
+            )
+            self._prepared = prepared
+        return prepared
+
+    def _candidates(self, prepared, market, language):
+        # Записи без рынка или языка подходят для любого запроса
+        _, alive, markets, languages, _ = prepared
+        mask = alive.copy()
+        if market is not None:
+            mask &= (markets == "") | (markets == market)
+        if language is not None:
+            mask &= (languages == "") | (languages == language)
+        return mask
+
+    def search_batch(self, texts, k=1, market=None, language=None):
+        # Для каждого запроса - список (вопрос, оценка, номер строки) по убыванию косинусного сходства;
+        # ответ берётся по номеру строки через get_answer
+        prepared = self._prepare()
+        matrix, query_idf = prepared[0], prepared[4]
+        if not len(self.rows):
+            return [[] for _ in texts]
+        queries = self._weigh(self.hasher.transform(texts), query_idf)
+        scores = (queries @ matrix).toarray()
+        scores[:, ~self._candidates(prepared, market, language)] = -1
+        k = min(k, scores.shape[1])
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([(self.records[i]["question"], float(row[i]), int(i)) for i in top if row[i] >= 0])
+        return results
+
+    def search(self, text, k=1, market=None, language=None):
+        return self.search_batch([text], k, market, language)[0]
+
+    def get_answer(self, row_or_key):
+        # Номер строки из результата поиска или ключ (вопрос, рынок, язык); строка - вопрос без рынка и языка
+        row = row_or_key if isinstance(row_or_key, int) else self.rows.get(_as_key(row_or_key))
+        record = self.records[row] if row is not None and 0 <= row < len(self.records) else None
+        return record["answer"] if record is not None else None
+
+    def save(self, path):
+        self._compact()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            data=self.counts.data, indices=self.counts.indices, indptr=self.counts.indptr,
+            doc_freq=self.doc_freq,
+            meta=np.array(json.dumps({
+                "version": INDEX_FORMAT_VERSION,
+                "n_features": self.n_features,
+                "fingerprint": self.fingerprint,
+                "records": self.records,
+            })),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] != INDEX_FORMAT_VERSION:
+                raise ValueError(f"Unsupported FAQ index version {meta['version']}")
+            index = cls(meta["n_features"])
+            index.counts = sparse.csr_matrix(
+                (data["data"], data["indices"], data["indptr"]), shape=(len(meta["records"]), meta["n_features"])
+            )
+            index.doc_freq = data["doc_freq"]
+        index.records = meta["records"]
+        index.rows = {record_key(record): row for row, record in enumerate(index.records)}
+        index.fingerprint = meta["fingerprint"]
+        return index
+
+
+def build_faq_index(faq_data, faq_dir=None):
+    index = FAQIndex()
+    index.add({"question": question, "answer": answer} for question, answer in faq_data.items())
+    if faq_dir and os.path.isdir(faq_dir):
+        index.add(read_faq_files(faq_dir))
+    index.fingerprint = faq_fingerprint(faq_data, faq_dir)
+    return index
+
+
+def load_or_build_faq_index(faq_data, faq_dir, index_path):
+    # Готовый индекс загружается с диска, если он собран из того же корпуса; иначе собирается и сохраняется
+    fingerprint = faq_fingerprint(faq_data, faq_dir)
+    if index_path and os.path.exists(index_path):
+        try:
+            index = FAQIndex.load(index_path)
+            if index.fingerprint == fingerprint:
+                return index
+        except Exception as e:
+            print(f"Failed to load FAQ index {index_path}: {e}")
+    index = build_faq_index(faq_data, faq_dir)
+    if index_path:
+        try:
+            index.save(index_path)
+        except OSError as e:
+            print(f"Failed to save FAQ index {index_path}: {e}")
+    return index
+
+
+if __name__ == "__main__":
+    # Офлайн-сборка индекса: python faq_index.py --faq-dir faq --output .cache/faq_index.npz
+    from faq import faq_data
+
+    parser = argparse.ArgumentParser(description="Build the FAQ search index")
+    parser.add_argument("--faq-dir", default=os.getenv("FAQ_DIR", "faq"))
+    parser.add_argument("--output", default=os.getenv("FAQ_INDEX_PATH", ".cache/faq_index.npz"))
+    args = parser.parse_args()
+    faq_index = build_faq_index(faq_data, args.faq_dir)
+    faq_index.save(args.output)
+    print(f"Saved {len(faq_index)} FAQ entries to {args.output}")
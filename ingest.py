@@ -0,0 +1,147 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Потоковая загрузка выгрузок, которые не помещаются в память целиком: CSV читается кусками с явными типами
+# строковых колонок и проекцией (ненужные колонки не разбираются), числа ужимаются до float32/int32,
+# повторяющиеся строки хранятся категориями. В режиме spill куски дополнительно пишутся в Parquet-набор,
+# а длинные текстовые колонки остаются только на диске и читаются лениво через ColumnStore.
+
+INGEST_MODE = os.getenv("INGEST_MODE", "memory")  # memory, chunked или spill
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "100000"))
+
+# Целые числа до 2**24 float32 хранит точно; колонки с большими значениями остаются float64
+FLOAT32_MAX_EXACT = 2**24
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _compact_chunk(chunk, categorial, numeric, bool_cols):
+    for col in numeric:
+        if col in chunk.columns:
+            values = chunk[col].astype("float64")
+            chunk[col] = values.astype("float32") if np.nanmax(np.abs(values.to_numpy()), initial=0) < FLOAT32_MAX_EXACT else values
+    for col in categorial:
+        if col in chunk.columns:
+            chunk[col] = chunk[col].astype("category")
+    for col in bool_cols:
+        if col in chunk.columns:
+            chunk[col] = chunk[col].astype(bool)
+    return chunk
+
+
+def _concat_chunks(chunks):
+    # У каждого куска свой набор категорий; приводим их к общему, иначе pd.concat вернёт object
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = pd.Index(np.unique(np.concatenate([chunk[col].cat.categories.to_numpy(dtype=object) for chunk in chunks])))
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True, copy=False)
+
+
+def _downcast_integers(df, numeric):
+    # Колонки без пропусков с целыми значениями - int32
+    for col in numeric:
+        if col not in df.columns:
+            continue
+        values = df[col].to_numpy()
+        if len(values) and not np.isnan(values).any() and np.array_equal(values, np.floor(values)) and np.abs(values).max() <= INT32_MAX:
+            df[col] = values.astype("int32")
+    return df
+
+
+class ColumnStoreWriter:
+    # Пишет куски в каталог Parquet с единой схемой: категории - строками, числа - float64
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.schema = None
+        self.parts = 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    def _schema(self, table):
+        fields = []
+        for field in table.schema:
+            if pa.types.is_dictionary(field.type):
+                field = field.with_type(pa.string())
+            elif pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+                field = field.with_type(pa.float64())
+            fields.append(field)
+        return pa.schema(fields)
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self.schema is None:
+            self.schema = self._schema(table).remove_metadata()
+        pq.write_table(table.cast(self.schema), os.path.join(self.tmp_path, f"part-{self.parts:05d}.parquet"))
+        self.parts += 1
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+
+class ColumnStore:
+    # Ленивый доступ к Parquet-набору: читаются только нужные колонки, фильтр применяется при сканировании
+    def __init__(self, path):
+        self.path = path
+        self.dataset = ds.dataset(path, format="parquet")
+
+    @property
+    def columns(self):
+        return self.dataset.schema.names
+
+    def scan(self, columns=None, filter=None, limit=None):
+        if limit is not None:
+            return self.dataset.head(limit, columns=columns, filter=filter).to_pandas()
+        return self.dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+    def search_text(self, column, text, columns, limit=10):
+        # Подстрока без учёта регистра; возвращает (число совпадений, первые limit строк), пакеты читаются потоком
+        matches, parts, collected = 0, [], 0
+        for batch in self.dataset.to_batches(columns=list(dict.fromkeys([column] + list(columns)))):
+            mask = pc.fill_null(pc.match_substring(batch.column(column), text, ignore_case=True), False)
+            count = pc.sum(mask).as_py() or 0
+            matches += count
+            if count and collected < limit:
+                part = batch.filter(mask).slice(0, limit - collected)
+                parts.append(part.select(list(columns)).to_pandas())
+                collected += part.num_rows
+        frame = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=list(columns))
+        return matches, frame
+
+
+def read_csv_chunked(file_path, preprocess, categorial, numeric, bool_cols, rename=None, dtype=None,
+                     skip_columns=(), drop_columns=(), cold_columns=(), store_path=None, chunk_rows=INGEST_CHUNK_ROWS):
+    # preprocess(chunk) - та же предобработка, что и для целого файла, применяется к каждому куску.
+    # skip_columns не читаются вовсе, drop_columns убираются после предобработки, cold_columns попадают
+    # только в Parquet-набор store_path. Возвращает (df, column_names, column_types) по схеме до удаления колонок.
+    rename = rename or {}
+    reader = pd.read_csv(
+        file_path, chunksize=chunk_rows, on_bad_lines="skip",
+        usecols=lambda name: rename.get(name, name) not in skip_columns,
+        dtype=dtype,
+    )
+    writer = ColumnStoreWriter(store_path) if store_path else None
+    chunks, column_names, column_types = [], None, None
+    for chunk in reader:
+        chunk = _compact_chunk(preprocess(chunk), categorial, numeric, bool_cols)
+        if column_names is None:
+            column_names, column_types = chunk.columns, chunk.dtypes
+        if writer:
+            writer.write(chunk)
+        chunks.append(chunk.drop(columns=[col for col in list(drop_columns) + list(cold_columns) if col in chunk.columns]))
+    if not chunks:
+        raise ValueError(f"{file_path} has no rows")
+    if writer:
+        writer.close()
+    df = _concat_chunks(chunks)
+    del chunks
+    return _downcast_integers(df, numeric), column_names, column_types
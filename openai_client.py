@@ -3,22 +3,30 @@ import os
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
-import mlflow
 from faq import faq_data, get_faq_response  # Абсолютный импорт
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
+from faq_index import faq_fingerprint, load_or_build_faq_index
 from langchain.agents.agent_types import AgentType
-from langchain_experimental.agents.agent_toolkits import create_csv_agent
+from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
 from langchain_community.llms import OpenAI
 from langchain_openai import ChatOpenAI
 import streamlit as st
-import matplotlib.pyplot as plt
 from io import BytesIO
 import base64
-import tempfile
-
+from collections import namedtuple
+from data_cache import cached_frame_path, column_store_path, file_content_hash, file_fingerprint, load_cached_data
+from ingest import INGEST_MODE, ColumnStore, read_csv_chunked
+from resources import ResourceRegistry, estimate_memory
+from query_engine import QueryEngine, fast_path_stats
+from analytics_index import AnalyticsIndex
+from langchain_core.tools import Tool
+from pipeline import QueryCancelled, QueryPipeline
+from plot_renderer import PlotRenderer
+from response_cache import ResponseCache
+from tracing import Tracer, TracingCallbackHandler, make_exporters
 
+# Copy-on-Write: поверхностные копии общего фрейма (у агента, у воркеров графиков) не могут изменить
+# сам фрейм, по позициям строк которого построены AnalyticsIndex и QueryEngine
+pd.set_option("mode.copy_on_write", True)
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -26,31 +34,61 @@ load_dotenv()
 # Установка ключа OpenAI API
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Загрузка и предобработка данных по недвижимости
-def load_and_preprocess_data(file_path):
-    df = pd.read_csv(file_path, on_bad_lines='skip', low_memory=False)
-    rename_dict = {
-        'Lat': 'Latitude',
-        'Lon': 'Longitude',
-        'Beds': 'Bedrooms',
-        'Street name': 'street_name'
-    }
+# Схема данных по недвижимости (имена колонок после переименования)
+rename_dict = {
+    'Lat': 'Latitude',
+    'Lon': 'Longitude',
+    'Beds': 'Bedrooms',
+    'Street name': 'street_name'
+}
+categorial = ['Property ID', 'Address', 'Status', 'Street number', 'street_name', 'Unit', 'City', 'Zip', 'Neighborhood', 'Area', 'MSA', 'County', 'State', 'FIPS Code', 'APN', 'Property Type', 'Style(s)', 'Pool', 'Heating', 'Cooling', 'Subdivision', 'Listing office name', 'Agent name', 'Agent phone', 'Agent email', 'MLS', 'FEMA zone', 'Noise / Airport', 'Noise / Traffic', 'Noise / Local', 'Noise / Score', 'Listing URL', 'Virtual tour', 'Description', 'Image URL', 'Listing ID', 'Owner 1 Email 1', 'Owner 1 Email 2', 'Owner 1 Phone Numbers', 'Owner 2 Name', 'Owner 2 Email 1', 'Owner 2 Email 2', 'Owner 2 Phone Numbers', 'Owner 3 Name', 'Owner 3 Email 1', 'Owner 3 Email 2', 'Owner 3 Phone Numbers', 'Owner 4 Name', 'Owner 4 Email 1', 'Owner 4 Email 2', 'Owner 4 Phone Numbers']
+numeric = ['Price', 'Stories', 'Age', 'Latitude', 'Longitude', 'Year Built', 'Bedrooms', 'Baths - full', 'Baths - half', 'Building area', 'Lot area', 'Garage', 'Price excludes land', 'List price per square foot', 'Days on market', 'Price reduction', 'Price reduction percentage', 'Value estimate', 'Value low', 'Value high', '6 month forecast', '12 month forecast', 'Rent estimate', 'Tax year', 'Tax amount', 'Property insurance rate', 'Property insurance estimate (annual)', 'Downpayment', 'Mortgage interest rate', 'Monthly mortgage payment (est.)', 'HOA fee', 'Gross yield', 'Cap rate', 'Fixed expenses per month', 'Variable expenses per month', 'Fixed closing costs', 'Variable closing costs', 'NOI (monthly)', 'Annual pre-tax cash flow', 'CoC', 'Last sold amount', 'Time since last sale (y)', 'Change since last sold', 'Change since last sold - %', 'Average annual change since last sold', 'Flood - FEMA factor score', 'Median age', 'Male percentage', 'Female percentage', 'Married percentage', 'Divorced percentage', 'Never married percentage', 'Widowed percentage', 'Average family size', 'Home ownership percentage', 'Unemployment rate', 'Race percentage: White', 'Race percentage: Black', 'Race percentage: Asian', 'Race percentage: Native or Alaska', 'Race percentage: Pacific', 'Race percentage: Other', 'Race percentage: Multiple', 'Ethnicity percentage: Hispanic', 'Residents aged 0-9 percentage', 'Residents aged 10-19 percentage', 'Residents aged 20-29 percentage', 'Residents aged 30-39 percentage', 'Residents aged 40-49 percentage', 'Residents aged 50-59 percentage', 'Residents aged 60-69 percentage', 'Residents aged 70-79 percentage', 'Residents aged over 80 percentage', 'Families with dual income percentage', 'Households with income under $5k', 'Households with income $5k-$10k', 'Households with income $10k-$15k', 'Households with income $15k-$20k', 'Households with income $20k-$25k', 'Households with income $25k-$35k', 'Households with income $35k-$50k', 'Households with income $50k-$75k', 'Households with income $75k-$100k', 'Households with income $100k-$150k', 'Households with income over $150k', 'Median household income', 'Median individual income', 'Rent burden', 'Less than high school percentage', 'High school percentage', 'Some college percentage', 'Batchelor percentage', 'Graduate degree percentage', 'Self-employed percentage', 'Median commute time', 'Uninsured percentage']
+dates = ['Date listed', 'Last sold date']
+bool_cols = ['Has pool', 'Has garage', 'New construction', 'Foreclosure', 'Coming soon', 'Pending', 'Short sale', 'Senior community', 'New Listing']
+
+# Контакты владельцев и агентов, ссылки и картинки: в потоковом режиме не читаются вовсе
+skipped_columns = [col for col in categorial if col.startswith('Owner ')] + ['Agent phone', 'Agent email', 'Listing URL', 'Virtual tour', 'Image URL']
+# Длинный текст и редко нужные идентификаторы: в режиме spill хранятся только в Parquet-наборе на диске
+cold_columns = ['Description', 'Subdivision', 'Listing office name', 'Agent name', 'MLS', 'Listing ID', 'APN', 'FIPS Code', 'Street number', 'street_name', 'Unit']
+
+# В режиме spill колонки Description нет в df - текст ищется инструментом search_text
+if INGEST_MODE == "spill":
+    description_guidance = """If you can't find an answer - search the Description column with the search_text tool or paraphrase request.
+        If you can't find a result in the neighborhood column - search it in Description with the search_text tool.
+        Feature df['Noise / Airport'] means noise level due to the airport, but you can check proximity to the airport in Description with the search_text tool also.
+        Columns missing from df (Description, Subdivision, Agent name and similar) can only be searched with the search_text tool, never through df."""
+else:
+    description_guidance = """If you can't find an answer - analyze Description by its content carefully in several steps step by step with sum() or any() on first step or paraphrase request.
+        If you can't find a result in the neighborhood column - try it in Description.
+        Feature df['Noise / Airport'] means noise level due to the airport, but you can check proximity to the airport in Description also."""
+# В потоковых режимах контакты владельцев и агентов, ссылки и картинки не загружаются вовсе
+if INGEST_MODE != "memory":
+    description_guidance += """
+        Owner names, emails and phone numbers, agent phones and emails, listing URLs, virtual tours and image URLs are not loaded: do not look for these columns in df, tell the user that this data is not available."""
+
+
+# Предобработка таблицы или её куска: переименование, производные колонки и приведение типов
+def preprocess_frame(df):
     df.rename(columns=rename_dict, inplace=True)
     df['Has pool'] = df['Pool'].notna()
     df['Has garage'] = df['Garage'].notna()
     df['Age'] = datetime.now().year - df['Year Built'].fillna(datetime.now().year)
-    categorial = ['Property ID', 'Address', 'Status', 'Street number', 'street_name', 'Unit', 'City', 'Zip', 'Neighborhood', 'Area', 'MSA', 'County', 'State', 'FIPS Code', 'APN', 'Property Type', 'Style(s)', 'Pool', 'Heating', 'Cooling', 'Subdivision', 'Listing office name', 'Agent name', 'Agent phone', 'Agent email', 'MLS', 'FEMA zone', 'Noise / Airport', 'Noise / Traffic', 'Noise / Local', 'Noise / Score', 'Listing URL', 'Virtual tour', 'Description', 'Image URL', 'Listing ID', 'Owner 1 Email 1', 'Owner 1 Email 2', 'Owner 1 Phone Numbers', 'Owner 2 Name', 'Owner 2 Email 1', 'Owner 2 Email 2', 'Owner 2 Phone Numbers', 'Owner 3 Name', 'Owner 3 Email 1', 'Owner 3 Email 2', 'Owner 3 Phone Numbers', 'Owner 4 Name', 'Owner 4 Email 1', 'Owner 4 Email 2', 'Owner 4 Phone Numbers']
     for col in categorial:
-        df[col] = df[col].fillna('No data available').astype(str)
-    numeric = ['Price', 'Stories', 'Age', 'Latitude', 'Longitude', 'Year Built', 'Bedrooms', 'Baths - full', 'Baths - half', 'Building area', 'Lot area', 'Garage', 'Price excludes land', 'List price per square foot', 'Days on market', 'Price reduction', 'Price reduction percentage', 'Value estimate', 'Value low', 'Value high', '6 month forecast', '12 month forecast', 'Rent estimate', 'Tax year', 'Tax amount', 'Property insurance rate', 'Property insurance estimate (annual)', 'Downpayment', 'Mortgage interest rate', 'Monthly mortgage payment (est.)', 'HOA fee', 'Gross yield', 'Cap rate', 'Fixed expenses per month', 'Variable expenses per month', 'Fixed closing costs', 'Variable closing costs', 'NOI (monthly)', 'Annual pre-tax cash flow', 'CoC', 'Last sold amount', 'Time since last sale (y)', 'Change since last sold', 'Change since last sold - %', 'Average annual change since last sold', 'Flood - FEMA factor score', 'Median age', 'Male percentage', 'Female percentage', 'Married percentage', 'Divorced percentage', 'Never married percentage', 'Widowed percentage', 'Average family size', 'Home ownership percentage', 'Unemployment rate', 'Race percentage: White', 'Race percentage: Black', 'Race percentage: Asian', 'Race percentage: Native or Alaska', 'Race percentage: Pacific', 'Race percentage: Other', 'Race percentage: Multiple', 'Ethnicity percentage: Hispanic', 'Residents aged 0-9 percentage', 'Residents aged 10-19 percentage', 'Residents aged 20-29 percentage', 'Residents aged 30-39 percentage', 'Residents aged 40-49 percentage', 'Residents aged 50-59 percentage', 'Residents aged 60-69 percentage', 'Residents aged 70-79 percentage', 'Residents aged over 80 percentage', 'Families with dual income percentage', 'Households with income under $5k', 'Households with income $5k-$10k', 'Households with income $10k-$15k', 'Households with income $15k-$20k', 'Households with income $20k-$25k', 'Households with income $25k-$35k', 'Households with income $35k-$50k', 'Households with income $50k-$75k', 'Households with income $75k-$100k', 'Households with income $100k-$150k', 'Households with income over $150k', 'Median household income', 'Median individual income', 'Rent burden', 'Less than high school percentage', 'High school percentage', 'Some college percentage', 'Batchelor percentage', 'Graduate degree percentage', 'Self-employed percentage', 'Median commute time', 'Uninsured percentage']
+        if col in df.columns:
+            df[col] = df[col].fillna('No data available').astype(str)
     for col in numeric:
         df[col] = pd.to_numeric(df[col], errors='coerce')
-    dates = ['Date listed', 'Last sold date']
     df['Date listed'] = pd.to_datetime(df['Date listed'])
     df['Last sold date'] = pd.to_datetime(df['Last sold date'])
-    bool_cols = ['Has pool', 'Has garage', 'New construction', 'Foreclosure', 'Coming soon', 'Pending', 'Short sale', 'Senior community', 'New Listing']
     for col in bool_cols:
         df[col] = df[col].fillna(False)
+    return df
+
+
+# Загрузка и предобработка данных по недвижимости
+def load_and_preprocess_data(file_path):
+    df = pd.read_csv(file_path, on_bad_lines='skip', low_memory=False)
+    df = preprocess_frame(df)
     column_names = df.columns
     column_types = df.dtypes
     dummies = pd.get_dummies(df['Property Type'])
@@ -59,20 +97,181 @@ def load_and_preprocess_data(file_path):
 
     return df, column_names, column_types, numeric, categorial, dates, bool_cols
 
-# Загрузка данных из CSV
+# Потоковая загрузка для файлов больше памяти: куски CSV с явными типами, float32/int32 и категории
+def load_and_preprocess_data_chunked(file_path, store_path=None):
+    raw_names = {new: old for old, new in rename_dict.items()}
+    df, column_names, column_types = read_csv_chunked(
+        file_path, preprocess_frame, categorial, numeric, bool_cols,
+        rename=rename_dict,
+        dtype={raw_names.get(col, col): str for col in categorial + dates},
+        skip_columns=skipped_columns,
+        drop_columns=['Baths - full', 'Baths - half'],
+        cold_columns=cold_columns if store_path else (),
+        store_path=store_path,
+    )
+    # Колонки-индикаторы добавляются на место, без копии всей таблицы через pd.concat
+    for name, column in pd.get_dummies(df['Property Type']).items():
+        df[name] = column
+    loaded = set(column_names)
+    return (df, column_names, column_types, [col for col in numeric if col in loaded],
+            [col for col in categorial if col in loaded], dates, bool_cols)
+
+
+Dataset = namedtuple("Dataset", ["df", "column_names", "column_types", "numeric", "categorial", "dates", "bool_cols", "unique_property_types_string"])
+
 file_path = "df.csv"
-df, column_names, column_types, numeric, categorial, dates, bool_cols = load_and_preprocess_data(file_path)
-unique_property_types_string = ", ".join(df['Property Type'].unique().tolist())
+# Режим загрузки (INGEST_MODE): memory - весь CSV сразу, chunked - по кускам с компактными типами,
+# spill - по кускам с Parquet-набором на диске; у каждого режима свой Feather-кэш
+cache_variant = "" if INGEST_MODE == "memory" else INGEST_MODE
+faq_dir = os.getenv("FAQ_DIR", "faq")
+faq_index_path = os.getenv("FAQ_INDEX_PATH", ".cache/faq_index.npz")
+
+
+def build_dataset():
+    # Загрузка данных из CSV (через колоночный кэш, CSV разбирается только при его изменении)
+    if INGEST_MODE == "memory":
+        preprocess, extra_paths = load_and_preprocess_data, ()
+    elif INGEST_MODE == "spill":
+        store_path = column_store_path(file_path, variant=cache_variant)
+        preprocess, extra_paths = lambda path: load_and_preprocess_data_chunked(path, store_path), (store_path,)
+    else:
+        preprocess, extra_paths = load_and_preprocess_data_chunked, ()
+    df, column_names, column_types, numeric, categorial, dates, bool_cols = load_cached_data(
+        file_path, preprocess, variant=cache_variant, extra_paths=extra_paths
+    )
+    unique_property_types_string = ", ".join(map(str, df['Property Type'].unique().tolist()))
+    return Dataset(df, column_names, column_types, numeric, categorial, dates, bool_cols, unique_property_types_string)
+
+
+def build_faq_index():
+    # Поисковый индекс FAQ (faq_data и файлы из FAQ_DIR); при неизменном корпусе загружается готовым с диска
+    return load_or_build_faq_index(faq_data, faq_dir, faq_index_path)
+
+
+def build_analytics_index():
+    # Предрасчёт сводок, групповых агрегатов и сортировок по ключевым метрикам
+    dataset = registry.get("dataset")
+    return AnalyticsIndex(dataset.df, dataset.numeric)
+
+
+def refresh_analytics_index(index):
+    # Если в df.csv только дописали строки, индекс дополняется ими; иначе None - и индекс строится заново
+    return index.append(registry.get("dataset").df)
+
+
+def build_query_engine():
+    dataset = registry.get("dataset")
+    return QueryEngine(dataset.df, dataset.numeric, dataset.categorial, dataset.bool_cols, registry.get("analytics"))
+
+
+def top_k_tool(tool_input):
+    # Вход: "metric, k[, asc]"
+    parts = [part.strip() for part in tool_input.split(",")]
+    index = registry.get("analytics")
+    k = int(parts[1]) if len(parts) > 1 and parts[1] else 5
+    ascending = len(parts) > 2 and parts[2].lower().startswith("asc")
+    return index.top_k(parts[0], k, ascending=ascending).to_markdown(index=False)
+
+
+def percentile_tool(tool_input):
+    # Вход: "metric, q"
+    metric, q = [part.strip() for part in tool_input.split(",")]
+    return str(registry.get("analytics").percentile(metric, float(q)))
+
+
+def group_summary_tool(tool_input):
+    # Вход: "group column, metric"
+    group, metric = [part.strip() for part in tool_input.split(",", 1)]
+    return registry.get("analytics").group_summary(group, metric).to_markdown()
+
+
+def search_text_tool(tool_input):
+    # Вход: "text" или "column, text"; поиск по колонкам, которые в режиме spill есть только на диске
+    column, text = [part.strip() for part in tool_input.split(",", 1)] if "," in tool_input else ("Description", tool_input.strip())
+    store = registry.get("column_store")
+    # Подстроку можно искать только в текстовых колонках из описания инструмента
+    if column not in cold_columns or column not in store.columns:
+        raise ValueError(f"column must be one of: {', '.join(col for col in cold_columns if col in store.columns)}")
+    matches, rows = store.search_text(column, text, ["Property ID", "Address", "Price", "Cap rate", column], limit=5)
+    return f"{matches} properties match. First {len(rows)}:\n{rows.to_markdown(index=False)}"
+
+
+def build_plot_renderer():
+    # Пул процессов для отрисовки графиков; воркеры читают тот же Feather-кэш, отображая его в память
+    dataset = registry.get("dataset")
+    return PlotRenderer(cached_frame_path(file_path, variant=cache_variant), dataset.df, registry.get("dataset_hash"))
+
+
+def safe_tool(func):
+    # Ошибка во входных данных инструмента возвращается агенту текстом, а не обрывает весь запрос
+    def run(tool_input):
+        try:
+            return func(tool_input)
+        except (KeyError, ValueError, IndexError) as e:
+            return f"Invalid input '{tool_input}': {e}"
+    return run
+
+
+def build_agent_tools():
+    ranked = ", ".join(registry.get("analytics").ranked_columns)
+    groups = ", ".join(registry.get("analytics").group_columns)
+    tools = [
+        Tool(name="top_k_properties", func=safe_tool(top_k_tool),
+             description=f"Top K properties by a metric from a precomputed index, instant. Input: 'metric, k' or 'metric, k, asc'. Metrics: {ranked}."),
+        Tool(name="metric_percentile", func=safe_tool(percentile_tool),
+             description=f"Percentile of a metric over all properties. Input: 'metric, q' with q in 0-100. Metrics: {ranked}."),
+        Tool(name="group_summary", func=safe_tool(group_summary_tool),
+             description=f"Count, mean, min and max of a metric per group. Input: 'group column, metric'. Groups: {groups}. Metrics: {ranked}."),
+    ]
+    if INGEST_MODE == "spill":
+        cold = ", ".join(col for col in cold_columns if col in registry.get("column_store").columns)
+        tools.append(Tool(name="search_text", func=safe_tool(search_text_tool),
+                          description=f"Case-insensitive substring search in columns that are not loaded into df: {cold}. Input: 'text' (searches Description) or 'column, text'. Returns the number of matches and the first five properties."))
+    return tools
+
+
+def build_agent():
+    # Настройка агента LangChain для работы с уже загруженным DataFrame (без повторного чтения CSV).
+    # Агент получает свою поверхностную копию: df.dropna(inplace=True) или df['Price'] = ... в его коде
+    # меняют только эту копию, а не общий фрейм других сессий и индексов
+    return create_pandas_dataframe_agent(
+        ChatOpenAI(temperature=0, model="gpt-4-turbo-preview", streaming=True, stream_usage=True),
+        registry.get("dataset").df.copy(deep=False),
+        verbose=True,
+        agent_type=AgentType.OPENAI_FUNCTIONS,
+        allow_dangerous_code=True,
+        extra_tools=build_agent_tools()
+    )
+
+
+# Общие для всех сессий ресурсы: строятся один раз на процесс и перестраиваются при изменении df.csv или FAQ
+registry = ResourceRegistry()
+registry.register("dataset", build_dataset, lambda: file_fingerprint(file_path))
+registry.register("faq", build_faq_index, lambda: faq_fingerprint(faq_data, faq_dir),
+                  memory=lambda index: estimate_memory((index.counts, index.doc_freq)))
+registry.register("dataset_hash", lambda: file_content_hash(file_path), lambda: file_fingerprint(file_path), memory=lambda digest: 0)
+# df у индекса общий с ресурсом dataset, поэтому считаем только собственные структуры
+registry.register("analytics", build_analytics_index, lambda: registry.version("dataset"),
+                  memory=lambda index: estimate_memory((index.sorted, index.group_sums, index.summaries)),
+                  refresh=refresh_analytics_index)
+registry.register("plot_renderer", build_plot_renderer, lambda: registry.version("dataset_hash"),
+                  memory=lambda renderer: renderer.stats()["bytes"], dispose=lambda renderer: renderer.close(), live_memory=True)
+if INGEST_MODE == "spill":
+    registry.register("column_store", lambda: ColumnStore(column_store_path(file_path, variant=cache_variant)),
+                      lambda: registry.version("dataset"), memory=lambda store: 0)
+registry.register("query_engine", build_query_engine, lambda: registry.version("dataset"), memory=lambda engine: 0)
+registry.register("agent", build_agent, lambda: registry.version("dataset"), memory=lambda agent: 0)
+
+# Кэш ответов агента, общий для всех сессий; хранится на диске, чтобы переживать перезапуск
+response_cache = ResponseCache(db_path=os.getenv("RESPONSE_CACHE_DB", ".cache/responses.sqlite"))
+
+# Спаны этапов обработки копятся в памяти и сбрасываются пачками в фоне (MLflow, файл или Prometheus)
+tracer = Tracer(make_exporters())
 
 
 # Инициализация истории чата для поддержания контекста
 chat_history = []
 
-# Инициализация TF-IDF Vectorizer и создание векторных представлений для вопросов из FAQ
-questions = list(faq_data.keys())
-vectorizer = TfidfVectorizer().fit(questions)
-question_vectors = vectorizer.transform(questions)
-
 def detect_support_request(prompt):
     support_keywords = ["help", "support", "problem", "issue", "trouble", "assistance", "contact", "urgent"]
     if any(keyword in prompt.lower() for keyword in support_keywords):
@@ -85,48 +284,59 @@ def save_support_request(prompt):
     return "Support request saved successfully."
 
 def vector_search_faq(prompt):
-    prompt_vector = vectorizer.transform([prompt])
-    cosine_similarities = cosine_similarity(prompt_vector, question_vectors).flatten()
-    most_similar_question_index = np.argmax(cosine_similarities)
-    if cosine_similarities[most_similar_question_index] > 0.7:
-        return questions[most_similar_question_index]
+    # (вопрос, номер строки) лучшего совпадения или None; по номеру строки берётся ответ именно этой записи
+    matches = registry.get("faq").search(prompt, k=1)
+    if matches and matches[0][1] > 0.7:
+        question, _, row = matches[0]
+        return question, row
     return None
 
-# Настройка агента LangChain для работы с CSV
-agent = create_csv_agent(
-    ChatOpenAI(temperature=0, model="gpt-4-turbo-preview"),
-    file_path,
-    verbose=True,
-    agent_type=AgentType.OPENAI_FUNCTIONS,
-    allow_dangerous_code=True
-)
-
-
-
-def handle_user_query(user_query):
-    if mlflow.active_run() is not None:
-        mlflow.end_run()
-
-    mlflow.start_run()
-    mlflow.log_param("user_prompt", user_query)
-
-    plot_path = None  # Инициализация переменной для хранения пути к графику
+def handle_user_query(user_query, callbacks=None, trace=None):
+    # Трассу может передать вызывающий код (страница досчитывает в неё время отрисовки и завершает сама)
+    own_trace = trace is None
+    trace = trace or tracer.start_trace()
+    trace.set(user_prompt=user_query[:500])
+    plot_data = None  # PNG графика, если ответ агента содержит код для него
 
     try:
-        if matched_question := vector_search_faq(user_query):
-            response = get_faq_response(matched_question)
-            mlflow.log_params({"response_type": "FAQ", "matched_question": matched_question})
-            mlflow.end_run()
-            return response, plot_path
+        with trace.span("faq_match"):
+            match = vector_search_faq(user_query)
+        if match:
+            matched_question, row = match
+            response = registry.get("faq").get_answer(row) or get_faq_response(matched_question)
+            trace.route = "faq"
+            trace.set(matched_question=matched_question)
+            return response, plot_data
 
-        if detect_support_request(user_query):
+        with trace.span("support_detection"):
+            is_support_request = detect_support_request(user_query)
+        if is_support_request:
             response = save_support_request(user_query)
-            mlflow.log_params({"response_type": "Support Request", "support_request_saved": "yes"})
-            mlflow.end_run()
-            return f"It looks like you need support. {response}", plot_path
+            trace.route = "support"
+            return f"It looks like you need support. {response}", plot_data
+
+        # Быстрый путь: типовые аналитические вопросы считаются напрямую по DataFrame, без агента
+        with trace.span("fast_path"):
+            fast_response = registry.get("query_engine").answer(user_query)
+        tracer.gauge("fast_path_hit_rate", fast_path_stats()["hit_rate"])
+        if fast_response is not None:
+            trace.route = "fast_path"
+            trace.set(response_length=len(fast_response))
+            return fast_response, plot_data
+
+        # Повторные вопросы берём из кэша ответов агента
+        with trace.span("response_cache"):
+            dataset_hash = registry.get("dataset_hash")
+            cached = response_cache.get(user_query, dataset_hash)
+        if cached:
+            response, plot_data = cached
+            trace.route = "cache"
+            trace.set(response_length=len(response))
+            return response, plot_data
 
         # Использование агента LangChain для обработки запроса
-        prompt = """
+        trace.route = "agent"
+        prompt = f"""
         Give the answer in the language in which the user asks the questions.
         The following analysis is based on real estate investment data.
         This includes factors like:
@@ -138,39 +348,50 @@ def handle_user_query(user_query):
         To find and assess profitability, focus on NOI, Cap rate and CoC and compare it.
         Find unique property types before filtering if the request concerns the type of property.
         Find unique property styles before filtering if the request concerns the style of property.
-        If you can't find an answer - analyze Description by its content carefully in several steps step by step with sum() or any() on first step or paraphrase request.
-        If you can't find a result in the neighborhood column - try it in Description.
+        {description_guidance}
         Column 'Median age' means age of citizens. Calculate the age of properties/houses by: the current year minus the year built.
-        Feature df['Noise / Airport'] means noise level due to the airport, but you can check proximity to the airport in Description also.
+        Text columns with repeated values (City, State, Zip, Property Type, Neighborhood and similar) are pandas categoricals: convert them with .astype(str) before concatenating or combining them with strings, and use groupby(..., observed=True) or drop zero counts after value_counts() so that categories absent from the filtered rows are not listed.
         If you are asked to find or show any objects: after receiving the data, it is not enough to say how many objects you found; you need to display selective 5 objects: ID and address.
+        For top K, percentile or per-group questions on the whole dataset without other filters, use the top_k_properties, metric_percentile and group_summary tools instead of scanning the dataframe.
         If you are asked to plot or build a graph of something, generate the Python code in triple quotes to create the plot using matplotlib without any explanatory text.
         Answer a user request for the following and explain your answer:
         """
 
-        response = agent.run(f"{prompt} {user_query}")
-        mlflow.log_params({"response_type": "Agent", "response_length": len(response)})
+        with trace.span("agent"):
+            response = registry.get("agent").run(f"{prompt} {user_query}", callbacks=(callbacks or []) + [TracingCallbackHandler(trace)])
+        trace.set(response_length=len(response))
 
-        # Если ответ содержит код для графика, выполняем его и сохраняем график
+        # Если ответ содержит код для графика, рисуем его в отдельном процессе и получаем PNG
         if "```python" in response:
+            trace.route = "plot"
             code = response.split("```python")[1].split("```")[0].strip()
             try:
-                exec(code, globals())
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmpfile:
-                    plt.savefig(tmpfile.name)
-                    plot_path = tmpfile.name
-                plt.close()
+                with trace.span("plot_render"):
+                    plot_data = registry.get("plot_renderer").render(code)
             except Exception as e:
                 response += f"\n\nError generating plot: {str(e)}"
 
-        mlflow.end_run()
-        return response.split("```")[0], plot_path  # Убираем отображение кода
-    except openai.error.InvalidRequestError as e:
+        if "Error generating plot" not in response:
+            response_cache.put(user_query, dataset_hash, response.split("```")[0], plot_data)
+
+        return response.split("```")[0], plot_data  # Убираем отображение кода
+    except QueryCancelled:
+        trace.set(cancelled=True)
+        raise
+    except openai.BadRequestError as e:
         error_message = f"Invalid request error: {str(e)}"
-        mlflow.log_params({"response_type": "Error", "error_message": error_message})
-        mlflow.end_run()
-        return error_message, plot_path
+        trace.route = "error"
+        trace.set(error_message=error_message[:500])
+        return error_message, plot_data
     except Exception as e:
         error_message = f"An error occurred: {str(e)}"
-        mlflow.log_params({"response_type": "Error", "error_message": error_message})
-        mlflow.end_run()
-        return error_message, plot_path
+        trace.route = "error"
+        trace.set(error_message=error_message[:500])
+        return error_message, plot_data
+    finally:
+        if own_trace:
+            trace.finish()
+
+
+# Общий пул обработки запросов: FAQ, поддержка, быстрый путь и агент выполняются вне потока страницы
+pipeline = QueryPipeline(handle_user_query)
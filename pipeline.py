@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Обработка запросов в общем для процесса пуле потоков с потоковой выдачей токенов и шагов агента.
+# Медленный запрос одного пользователя не блокирует остальных, а страница получает первые байты сразу.
+
+MAX_WORKERS = int(os.getenv("QUERY_WORKERS", "8"))
+MAX_PENDING = int(os.getenv("QUERY_MAX_PENDING", str(MAX_WORKERS * 4)))
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "120"))
+STEP_PREVIEW_LENGTH = 500
+DONE = object()  # кладётся в очередь событий по завершении задачи, чтобы поток ответа не ждал таймаута опроса
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class PipelineBusy(Exception):
+    pass
+
+
+class StreamingCallbackHandler(BaseCallbackHandler):
+    # Без raise_error LangChain проглатывает исключения из обработчиков, и отмена не сработала бы
+    raise_error = True
+
+    def __init__(self, events, cancelled):
+        self.events = events
+        self.cancelled = cancelled
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise QueryCancelled()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._check()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._check()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self._check()
+        if token:
+            self.events.put(("token", token))
+
+    def on_agent_action(self, action, **kwargs):
+        self._check()
+        self.events.put(("step", f"`{action.tool}`: {action.tool_input}"))
+
+    def on_tool_end(self, output, **kwargs):
+        self._check()
+        output = str(output)
+        if len(output) > STEP_PREVIEW_LENGTH:
+            output = output[:STEP_PREVIEW_LENGTH] + "..."
+        self.events.put(("step", output))
+
+
+class QueryStream:
+    def __init__(self, future, events, cancelled):
+        self.future = future
+        self.queue = events
+        self.cancelled = cancelled
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+    def events(self, timeout=QUERY_TIMEOUT):
+        # Генератор событий: ("token", str), ("step", str), затем одно из ("result", (ответ, график)),
+        # ("error", сообщение) или ("timeout", None)
+        deadline = time.monotonic() + timeout
+        finished = False
+        try:
+            while True:
+                try:
+                    event = self.queue.get(timeout=0.05)
+                    if event is not DONE:
+                        yield event
+                        continue
+                except queue.Empty:
+                    pass
+                if self.future.done():
+                    finished = True
+                    try:
+                        outcome = "result", self.future.result()
+                    except QueryCancelled:
+                        outcome = "error", "The request was cancelled."
+                    except Exception as e:
+                        outcome = "error", str(e)
+                    yield outcome
+                    return
+                if time.monotonic() > deadline:
+                    yield "timeout", None
+                    return
+        finally:
+            # Таймаут или уход пользователя со страницы (Streamlit прерывает скрипт) - отменяем запрос
+            if not finished:
+                self.cancel()
+
+
+class QueryPipeline:
+    def __init__(self, handler, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query")
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, user_query, events, cancelled, handler_kwargs):
+        if cancelled.is_set():
+            raise QueryCancelled()
+        return self.handler(user_query, callbacks=[StreamingCallbackHandler(events, cancelled)], **handler_kwargs)
+
+    def submit(self, user_query, **handler_kwargs):
+        # handler_kwargs передаются обработчику как есть (например, trace)
+        if not self.slots.acquire(blocking=False):
+            raise PipelineBusy("Too many requests are being processed right now. Please try again shortly.")
+        events, cancelled = queue.Queue(), threading.Event()
+        try:
+            future = self.executor.submit(self._run, user_query, events, cancelled, handler_kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        # Слот освобождается и при завершении, и при отмене ещё не начатой задачи
+        future.add_done_callback(lambda _: self.slots.release())
+        future.add_done_callback(lambda _: events.put(DONE))
+        return QueryStream(future, events, cancelled)
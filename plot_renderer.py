@@ -0,0 +1,487 @@
+import ast
+import builtins
+import hashlib
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import types
+from collections import OrderedDict
+from io import BytesIO
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows: лимиты процесса недоступны
+    resource = None
+
+# Отрисовка графиков из кода, сгенерированного агентом, в отдельных процессах.
+# Каждый процесс строит свою Figure через объектный API matplotlib, поэтому параллельные запросы
+# не делят состояние pyplot; результат возвращается байтами PNG/SVG и кэшируется по хэшу кода и версии данных.
+# Код выполняется только с разрешёнными именами: pd и np - наборы функций без подмодулей (PANDAS_NAMES,
+# NUMPY_NAMES), каждое обращение к атрибуту проходит через _guarded_getattr, который не отдаёт модули,
+# кадры стека и методы ввода-вывода. Урезанных builtins недостаточно: через атрибуты объектов
+# (pd.compat.os, df.__class__.__init__.__globals__) достижимы os и настоящие builtins.
+
+PLOT_WORKERS = int(os.getenv("PLOT_WORKERS", "2"))
+PLOT_TIMEOUT = float(os.getenv("PLOT_TIMEOUT", "30"))
+# Запуск пула (spawn, импорты, открытие данных) ограничивается отдельно и не входит в PLOT_TIMEOUT запроса
+PLOT_START_TIMEOUT = float(os.getenv("PLOT_START_TIMEOUT", "120"))
+PLOT_CPU_SECONDS = int(os.getenv("PLOT_CPU_SECONDS", "20"))
+PLOT_MEMORY_LIMIT_MB = int(os.getenv("PLOT_MEMORY_LIMIT_MB", "4096"))
+PLOT_CACHE_BYTES = int(os.getenv("PLOT_CACHE_MB", "64")) * 2**20
+
+ALLOWED_MODULES = {"numpy", "pandas", "math", "matplotlib", "matplotlib.pyplot"}
+SAFE_BUILTINS = [
+    "abs", "all", "any", "bool", "dict", "divmod", "enumerate", "filter", "float", "format", "frozenset", "int",
+    "isinstance", "len", "list", "map", "max", "min", "pow", "range", "repr", "reversed", "round", "set", "slice",
+    "sorted", "str", "sum", "tuple", "zip", "True", "False", "None", "Exception", "ValueError", "KeyError",
+    "TypeError", "IndexError", "ZeroDivisionError",
+]
+# Всё, что код графика может взять из pandas и numpy; остальные атрибуты pd/np (compat, io, errors, read_*, load...)
+# отклоняются ещё при проверке кода
+PANDAS_NAMES = {
+    "DataFrame", "Series", "Index", "Categorical", "Timestamp", "Timedelta", "NaT", "NA", "Grouper", "NamedAgg",
+    "date_range", "period_range", "timedelta_range", "to_datetime", "to_numeric", "to_timedelta", "cut", "qcut",
+    "concat", "merge", "crosstab", "pivot_table", "melt", "get_dummies", "factorize", "unique",
+    "isna", "isnull", "notna", "notnull",
+}
+NUMPY_NAMES = {
+    "array", "asarray", "arange", "linspace", "logspace", "zeros", "ones", "full", "zeros_like", "ones_like",
+    "full_like", "eye", "meshgrid", "concatenate", "stack", "vstack", "hstack", "column_stack", "repeat", "tile",
+    "reshape", "transpose", "flip", "roll", "sort", "argsort", "argmax", "argmin", "searchsorted", "unique",
+    "where", "select", "clip", "nonzero", "count_nonzero", "any", "all", "isnan", "isfinite", "isinf", "isclose",
+    "allclose", "sum", "prod", "cumsum", "cumprod", "diff", "gradient", "mean", "average", "median", "std", "var",
+    "min", "max", "amin", "amax", "ptp", "percentile", "quantile", "nansum", "nanmean", "nanmedian", "nanstd",
+    "nanvar", "nanmin", "nanmax", "nanpercentile", "nanquantile", "histogram", "histogram2d", "bincount",
+    "digitize", "interp", "convolve", "corrcoef", "cov", "polyfit", "polyval", "poly1d", "dot", "outer",
+    "abs", "absolute", "sign", "sqrt", "square", "power", "exp", "expm1", "log", "log1p", "log2", "log10",
+    "floor", "ceil", "round", "around", "rint", "trunc", "mod", "maximum", "minimum", "sin", "cos", "tan",
+    "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh", "deg2rad", "rad2deg", "radians", "degrees",
+    "hypot", "nan", "inf", "pi", "e", "newaxis", "float64", "float32", "int64", "int32", "bool_", "datetime64",
+    "timedelta64",
+}
+NUMPY_RANDOM_NAMES = {"rand", "randn", "randint", "random", "normal", "uniform", "choice", "seed", "default_rng"}
+
+# Функции доступа к атрибутам и пространствам имён по строке
+FORBIDDEN_NAMES = {"getattr", "setattr", "delattr", "hasattr", "vars", "globals", "locals", "dir", "eval", "exec",
+                   "compile", "open", "type", "object", "super", "breakpoint", "input", "help", "memoryview"}
+# Атрибуты любых объектов: чтение и запись файлов, исполнение строк, доступ по строке (str.format), холст и LaTeX
+FORBIDDEN_ATTRIBUTES = {"eval", "query", "format", "format_map", "load", "loads", "dump", "dumps", "tofile",
+                        "fromfile", "memmap", "save", "savez", "savez_compressed", "savetxt", "loadtxt",
+                        "genfromtxt", "ctypes", "ctypeslib", "style", "canvas", "figure", "savefig", "set_usetex",
+                        "ExcelWriter", "HDFStore", "DataSource"}
+FORBIDDEN_ATTRIBUTE_PREFIXES = ("read_", "print_")
+# Из to_* разрешены только преобразования в памяти; to_csv, to_pickle, to_string(buf=...) и т.п. пишут файлы
+ALLOWED_TO_ATTRIBUTES = {"to_numpy", "to_list", "to_dict", "to_frame", "to_series", "to_records", "to_period",
+                         "to_timestamp", "to_pydatetime", "to_flat_index", "to_datetime", "to_numeric",
+                         "to_timedelta"}
+# backend= импортирует модуль по имени (df.plot), usetex=True запускает latex
+FORBIDDEN_KEYWORDS = {"backend", "usetex"}
+# Значения атрибутов, через которые достижимы модули и глобальные переменные (gen.gi_frame.f_globals)
+UNSAFE_VALUE_TYPES = (types.ModuleType, types.FrameType, types.CodeType, types.TracebackType)
+_GUARD_NAME = "__plot_getattr__"
+
+
+class PlotError(Exception):
+    pass
+
+
+def _is_dunder(name):
+    return name.startswith("__") and name.endswith("__")
+
+
+def _attribute_allowed(name):
+    if name.startswith("_") or name in FORBIDDEN_ATTRIBUTES or name.startswith(FORBIDDEN_ATTRIBUTE_PREFIXES):
+        return False
+    return not name.startswith("to_") or name in ALLOWED_TO_ATTRIBUTES
+
+
+def _module_attribute_allowed(node):
+    # pd.X, np.X и np.random.X - только из списков разрешённых имён
+    if isinstance(node.value, ast.Name):
+        if node.value.id == "pd":
+            return node.attr in PANDAS_NAMES
+        if node.value.id == "np":
+            return node.attr in NUMPY_NAMES or node.attr == "random"
+    if isinstance(node.value, ast.Attribute) and node.value.attr == "random" \
+            and isinstance(node.value.value, ast.Name) and node.value.value.id == "np":
+        return node.attr in NUMPY_RANDOM_NAMES
+    return True
+
+
+def check_plot_code(code):
+    # Возвращает дерево разбора или бросает PlotError, если код обращается к dunder-именам, к функциям доступа
+    # к атрибутам по строке, к неразрешённым частям pd/np, к вводу-выводу или присваивает атрибуты
+    try:
+        tree = ast.parse(code, "<plot>", "exec")
+    except SyntaxError as e:
+        raise PlotError(f"SyntaxError: {e}") from None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and (_is_dunder(node.id) or node.id in FORBIDDEN_NAMES):
+            raise PlotError(f"Name '{node.id}' is not allowed in plot code")
+        if isinstance(node, ast.Attribute):
+            if not isinstance(node.ctx, ast.Load):
+                raise PlotError(f"Assigning attribute '{node.attr}' is not allowed in plot code")
+            if not _module_attribute_allowed(node):
+                raise PlotError(f"'{ast.unparse(node)}' is not available in plot code")
+            # plt.figure/plt.savefig - методы PyplotShim без доступа к файлам и холсту
+            plt_method = isinstance(node.value, ast.Name) and node.value.id == "plt" and node.attr in ("figure", "savefig")
+            if not plt_method and not _attribute_allowed(node.attr):
+                raise PlotError(f"Attribute '{node.attr}' is not allowed in plot code")
+        if isinstance(node, ast.keyword) and (node.arg is None or node.arg in FORBIDDEN_KEYWORDS):
+            raise PlotError(f"Keyword argument '{node.arg or '**'}' is not allowed in plot code")
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and "__" in node.value:
+            # Строки формата вида "{0.__class__}" дают тот же доступ через str.format
+            raise PlotError("Strings containing '__' are not allowed in plot code")
+    return tree
+
+
+class _GuardAttributes(ast.NodeTransformer):
+    # obj.name -> __plot_getattr__(obj, "name"): проверка во время выполнения для объектов, тип которых
+    # по коду не виден (ax.figure, gen.gi_frame, значения из pd/np)
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        call = ast.Call(ast.Name(_GUARD_NAME, ast.Load()), [node.value, ast.Constant(node.attr)], [])
+        return ast.copy_location(call, node)
+
+
+def _guarded_getattr(obj, name):
+    if not _attribute_allowed(name) and not (obj is _worker.get("plt") and name in ("figure", "savefig")):
+        raise PlotError(f"Attribute '{name}' is not allowed in plot code")
+    value = getattr(obj, name)
+    if isinstance(value, UNSAFE_VALUE_TYPES):
+        raise PlotError(f"Attribute '{name}' is not allowed in plot code")
+    return value
+
+
+class _Namespace:
+    # Разрешённые функции модуля без самого модуля и его подмодулей
+    def __init__(self, label, module, names, **extra):
+        self._label = label
+        for name in names:
+            if hasattr(module, name):
+                setattr(self, name, getattr(module, name))
+        for name, value in extra.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        raise AttributeError(f"{self._label}.{name} is not available in plot code")
+
+
+class PyplotShim:
+    # Подмножество pyplot поверх конкретной Figure: код агента пишет plt.hist(...), plt.title(...),
+    # а рисование идёт в Figure этого запроса, а не в глобальное состояние pyplot
+    def __init__(self, figure):
+        self._figure = figure
+        self._axes = None
+
+    def gcf(self):
+        return self._figure
+
+    def gca(self):
+        if self._axes is None:
+            self._axes = self._figure.axes[0] if self._figure.axes else self._figure.add_subplot()
+        return self._axes
+
+    def figure(self, *args, figsize=None, **kwargs):
+        if figsize is not None:
+            self._figure.set_size_inches(figsize)
+        return self._figure
+
+    def subplots(self, nrows=1, ncols=1, figsize=None, **kwargs):
+        self._figure.clear()
+        if figsize is not None:
+            self._figure.set_size_inches(figsize)
+        axes = self._figure.subplots(nrows, ncols, **kwargs)
+        self._axes = axes if nrows == ncols == 1 else axes.flat[0]
+        return self._figure, axes
+
+    def subplot(self, *args, **kwargs):
+        self._axes = self._figure.add_subplot(*args, **kwargs)
+        return self._axes
+
+    def sca(self, axes):
+        self._axes = axes
+
+    def title(self, label, **kwargs):
+        return self.gca().set_title(label, **kwargs)
+
+    def suptitle(self, label, **kwargs):
+        return self._figure.suptitle(label, **kwargs)
+
+    def xlabel(self, label, **kwargs):
+        return self.gca().set_xlabel(label, **kwargs)
+
+    def ylabel(self, label, **kwargs):
+        return self.gca().set_ylabel(label, **kwargs)
+
+    def xlim(self, *args, **kwargs):
+        return self.gca().set_xlim(*args, **kwargs)
+
+    def ylim(self, *args, **kwargs):
+        return self.gca().set_ylim(*args, **kwargs)
+
+    def _ticks(self, axis, ticks=None, labels=None, **kwargs):
+        if ticks is not None:
+            axis.set_ticks(ticks, labels)
+        for label in axis.get_ticklabels():
+            label.update(kwargs)
+
+    def xticks(self, ticks=None, labels=None, **kwargs):
+        self._ticks(self.gca().xaxis, ticks, labels, **kwargs)
+
+    def yticks(self, ticks=None, labels=None, **kwargs):
+        self._ticks(self.gca().yaxis, ticks, labels, **kwargs)
+
+    def tight_layout(self, **kwargs):
+        self._figure.tight_layout(**kwargs)
+
+    def show(self, *args, **kwargs):
+        pass
+
+    def savefig(self, *args, **kwargs):
+        pass
+
+    def close(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        # plt.hist, plt.bar, plt.scatter, plt.legend, plt.grid и т.п. - методы текущих осей
+        return getattr(self.gca(), name)
+
+
+# Состояние процесса-воркера
+_worker = {}
+
+
+def _init_worker(frame_path, frame, memory_limit_mb):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401 - импорт до очистки окружения, дальше он берётся из кэша модулей
+    import numpy as np
+    import pandas as pd
+    import pyarrow.feather as feather
+
+    # Copy-on-Write: код агента получает поверхностную копию, и любые изменения не затрагивают общий фрейм
+    pd.set_option("mode.copy_on_write", True)
+    if frame is None:
+        # Arrow-таблица над отображённым в память файлом: страницы общие с другими процессами,
+        # в pandas переводятся только колонки, которые использует код графика
+        _worker["table"] = feather.read_table(frame_path, memory_map=True)
+    else:
+        _worker["df"] = frame
+    _worker["pd"] = _Namespace("pd", pd, PANDAS_NAMES)
+    _worker["np"] = _Namespace("np", np, NUMPY_NAMES, random=_Namespace("np.random", np.random, NUMPY_RANDOM_NAMES))
+    # Вторая линия защиты на случай обхода проверок: без ключей API в окружении и PATH,
+    # без записи в файлы (RLIMIT_FSIZE наследуют и дочерние процессы)
+    os.environ.clear()
+    if resource is not None:
+        signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+        resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+        if memory_limit_mb:
+            limit = memory_limit_mb * 2**20
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _ping():
+    return True
+
+
+def _is_row_filter(node):
+    # df[mask]: сравнения, &, |, ~ и методы, возвращающие маску
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor))
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, (ast.Invert, ast.Not))
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in (
+        "isin", "between", "notna", "notnull", "isna", "isnull", "contains", "startswith", "endswith")
+
+
+def _is_column_selection(node):
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, str)
+    return isinstance(node, (ast.List, ast.Tuple)) and bool(node.elts) and all(
+        isinstance(item, ast.Constant) and isinstance(item.value, str) for item in node.elts)
+
+
+def _selects_columns(name, parents, columns):
+    # True, если df используется как df['A'], df[['A', 'B']], df.A, df.loc[mask, 'A'], возможно после
+    # фильтров строк df[mask]; всё остальное (df.select_dtypes, df.describe(), data = df) требует всего фрейма
+    current = name
+    while True:
+        parent = parents.get(current)
+        if isinstance(parent, ast.Attribute) and parent.value is current:
+            if parent.attr in columns:
+                return True
+            if parent.attr != "loc":
+                return False
+            selection = parents.get(parent)
+            if not isinstance(selection, ast.Subscript) or selection.value is not parent:
+                return False
+            key = selection.slice
+            if isinstance(key, ast.Tuple) and len(key.elts) == 2:
+                return _is_column_selection(key.elts[1])
+            if not _is_row_filter(key):
+                return False
+            current = selection
+        elif isinstance(parent, ast.Subscript) and parent.value is current:
+            if _is_column_selection(parent.slice):
+                return True
+            if not _is_row_filter(parent.slice):
+                return False
+            current = parent
+        else:
+            return False
+
+
+def _frame_for(tree):
+    if "df" in _worker:
+        return _worker["df"].copy(deep=False)
+    table = _worker["table"]
+    columns = set(table.column_names)
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    uses = [node for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id == "df"]
+    if not uses or not all(_selects_columns(node, parents, columns) for node in uses):
+        return table.to_pandas()
+    # Все обращения к df выбирают колонки явно - переводим в pandas только упомянутые в коде
+    mentioned = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            mentioned.add(node.value)
+        elif isinstance(node, ast.Attribute):
+            mentioned.add(node.attr)
+    return table.select([name for name in table.column_names if name in mentioned]).to_pandas()
+
+
+def _restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name not in ALLOWED_MODULES:
+        raise ImportError(f"Import of '{name}' is not allowed in plot code")
+    if name.startswith("matplotlib"):
+        return SimpleNamespace(pyplot=_worker["plt"])
+    if name == "math":
+        return math
+    return _worker["pd" if name == "pandas" else "np"]
+
+
+def _render(code, fmt, cpu_seconds):
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+
+    if resource is not None and cpu_seconds:
+        # Лимит процессорного времени на задачу: при превышении ОС завершает воркер, пул поднимает новый
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+    tree = check_plot_code(code)
+    df = _frame_for(tree)
+    guarded = ast.fix_missing_locations(_GuardAttributes().visit(tree))
+    figure = Figure(figsize=(8, 5))
+    shim = PyplotShim(figure)
+    _worker["plt"] = shim
+    safe_builtins = {name: getattr(builtins, name) for name in SAFE_BUILTINS}
+    safe_builtins["__import__"] = _restricted_import
+    safe_builtins["print"] = lambda *args, **kwargs: None
+    namespace = {
+        "__builtins__": safe_builtins,
+        _GUARD_NAME: _guarded_getattr,
+        "df": df,
+        "pd": _worker["pd"],
+        "np": _worker["np"],
+        "math": math,
+        "plt": shim,
+    }
+    try:
+        exec(compile(guarded, "<plot>", "exec"), namespace)
+        # Построения pandas (df.plot, Series.hist) без ax= рисуют в pyplot - берём такую фигуру, если своя пуста
+        target = figure
+        if not figure.axes and plt.get_fignums():
+            target = plt.gcf()
+        if not target.axes:
+            raise PlotError("The code did not draw anything")
+        buffer = BytesIO()
+        target.savefig(buffer, format=fmt, bbox_inches="tight")
+        return buffer.getvalue()
+    except PlotError:
+        raise
+    except Exception as e:
+        raise PlotError(f"{type(e).__name__}: {e}") from None
+    finally:
+        plt.close("all")
+
+
+class PlotRenderer:
+    def __init__(self, frame_path=None, frame=None, dataset_version=None, workers=PLOT_WORKERS,
+                 timeout=PLOT_TIMEOUT, cpu_seconds=PLOT_CPU_SECONDS, memory_limit_mb=PLOT_MEMORY_LIMIT_MB,
+                 cache_bytes=PLOT_CACHE_BYTES):
+        # frame_path - несжатый Feather-файл из data_cache: воркеры отображают его в память и читают колонки
+        # по требованию; без него фрейм передаётся каждому воркеру копией
+        self.dataset_version = dataset_version
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(frame_path, None if frame_path else frame, memory_limit_mb),
+        )
+        self._ready = self._pool.apply_async(_ping)
+
+    def _key(self, code, fmt):
+        return hashlib.sha256(f"{self.dataset_version}\x1f{fmt}\x1f{code}".encode("utf-8")).hexdigest()
+
+    def _cache_get(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+            return data
+
+    def _cache_put(self, key, data):
+        with self._lock:
+            if key in self._cache or len(data) > self.cache_bytes:
+                return
+            self._cache[key] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+
+    def render(self, code, fmt="png"):
+        key = self._key(code, fmt)
+        if (data := self._cache_get(key)) is not None:
+            return data
+        # Задачу берёт только воркер, прошедший инициализацию, поэтому таймаут запроса считаем после готовности пула
+        try:
+            self._ready.get(timeout=PLOT_START_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            raise PlotError(f"Plot workers did not start within {PLOT_START_TIMEOUT:.0f} s") from None
+        result = self._pool.apply_async(_render, (code, fmt, self.cpu_seconds))
+        try:
+            data = result.get(timeout=self.timeout)
+        except multiprocessing.TimeoutError:
+            raise PlotError(f"Plot rendering took longer than {self.timeout:.0f} s") from None
+        self._cache_put(key, data)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "bytes": self._cache_size}
+
+    def close(self):
+        # Уже принятые задачи дорисовываются, после чего воркеры завершаются
+        self._pool.close()
@@ -0,0 +1,320 @@
+import re
+import threading
+
+import pandas as pd
+
+# Быстрый детерминированный путь для типовых аналитических вопросов (top N, средние, распределения),
+# который отвечает без обращения к агенту LangChain. Если в вопросе есть хоть одно непонятое слово,
+# парсер возвращает None и запрос уходит агенту.
+
+METRIC_ALIASES = {
+    "cap rate": "Cap rate",
+    "capitalization rate": "Cap rate",
+    "coc": "CoC",
+    "cash on cash": "CoC",
+    "cash on cash return": "CoC",
+    "noi": "NOI (monthly)",
+    "net operating income": "NOI (monthly)",
+    "hoa": "HOA fee",
+    "hoa fee": "HOA fee",
+    "hoa fees": "HOA fee",
+    "gross yield": "Gross yield",
+    "yield": "Gross yield",
+    "price": "Price",
+    "prices": "Price",
+    "rent": "Rent estimate",
+    "cash flow": "Annual pre-tax cash flow",
+    "price per square foot": "List price per square foot",
+    "price per sqft": "List price per square foot",
+    "days on market": "Days on market",
+    "age": "Age",
+    "bedrooms": "Bedrooms",
+    "beds": "Bedrooms",
+    "area": "Building area",
+    "building area": "Building area",
+    "lot area": "Lot area",
+    "lot size": "Lot area",
+}
+
+# Колонки, значения которых распознаются в тексте как фильтры
+FILTER_COLUMNS = ["City", "Zip", "Neighborhood", "County", "State", "Property Type"]
+
+GROUP_ALIASES = {
+    "city": "City",
+    "cities": "City",
+    "zip": "Zip",
+    "zip code": "Zip",
+    "zipcode": "Zip",
+    "neighborhood": "Neighborhood",
+    "neighborhoods": "Neighborhood",
+    "county": "County",
+    "counties": "County",
+    "state": "State",
+    "property type": "Property Type",
+    "property types": "Property Type",
+    "type": "Property Type",
+}
+
+BOOL_ALIASES = {
+    "pool": "Has pool",
+    "garage": "Has garage",
+    "new construction": "New construction",
+    "foreclosure": "Foreclosure",
+    "foreclosures": "Foreclosure",
+    "short sale": "Short sale",
+    "senior community": "Senior community",
+    "pending": "Pending",
+    "coming soon": "Coming soon",
+}
+
+TOP_WORDS = {"top", "best", "highest", "most", "largest", "biggest", "greatest", "maximum", "max"}
+BOTTOM_WORDS = {"lowest", "cheapest", "least", "smallest", "bottom", "minimum", "min", "worst"}
+AGG_WORDS = {
+    "average": "mean", "avg": "mean", "mean": "mean",
+    "median": "median",
+    "total": "sum", "sum": "sum",
+}
+COUNT_PHRASES = ["how many", "number of", "count of", "count"]
+DISTRIBUTION_WORDS = {"distribution", "spread", "percentiles", "quantiles", "range", "statistics", "stats"}
+GROUP_MARKERS = ["for each", "in each", "by", "per", "across", "grouped by"]
+
+# Слова, которые не несут смысла для быстрого пути
+FILLER_WORDS = {
+    "show", "me", "list", "find", "give", "get", "display", "what", "which", "is", "are", "was", "the", "a", "an",
+    "of", "in", "for", "with", "by", "per", "each", "all", "and", "properties", "property", "houses", "house",
+    "homes", "home", "listings", "listing", "objects", "object", "units", "there", "do", "does", "we", "have",
+    "please", "to", "on", "at", "value", "values", "rate", "fee", "fees", "that", "has", "having", "located",
+    "investment", "investments", "return", "returns", "across", "grouped", "i", "can", "you", "tell", "about",
+    "re", "s", "sorted", "ranked", "order", "ordered", "options", "estate", "real", "it", "its", "whose", "where",
+    "city", "zip", "code", "county", "neighborhood", "state", "type",
+}
+
+# Запросы, требующие рассуждений, графиков или поиска по описанию, всегда отдаём агенту
+ESCALATE_WORDS = {
+    "plot", "graph", "chart", "draw", "visualize", "visualise", "histogram", "why", "explain", "compare",
+    "description", "near", "close", "recommend", "should", "profitable", "not", "without", "except", "between",
+    "above", "below", "under", "over", "than", "less", "more",
+}
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "twenty": 20}
+DEFAULT_TOP_N = 5
+MAX_TOP_N = 50
+MAX_GROUPS = 20
+MISSING_VALUE = "No data available"
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def record_hit(hit):
+    with _stats_lock:
+        _stats["hits" if hit else "misses"] += 1
+
+
+def fast_path_stats():
+    # Доля запросов, обработанных без LLM
+    with _stats_lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {"hits": _stats["hits"], "misses": _stats["misses"], "hit_rate": _stats["hits"] / total if total else 0.0}
+
+
+def tokenize(text):
+    tokens = (token.strip(".-'") for token in re.findall(r"[a-z0-9$%\-\.']+", text.lower().replace("'s", " s")))
+    return [token for token in tokens if token]
+
+
+class QueryEngine:
+    def __init__(self, df, numeric, categorial, bool_cols, index=None):
+        self.df = df
+        self.index = index  # AnalyticsIndex с предрасчитанными сортировками, если есть
+        self.numeric = [col for col in numeric if col in df.columns]
+        self.bool_cols = [col for col in bool_cols if col in df.columns]
+
+        # Синонимы метрик плюс названия всех числовых колонок
+        self.metrics = {alias: col for alias, col in METRIC_ALIASES.items() if col in df.columns}
+        for col in self.numeric:
+            self.metrics.setdefault(" ".join(tokenize(col)), col)
+        self.bools = {alias: col for alias, col in BOOL_ALIASES.items() if col in df.columns}
+        self.groups = {alias: col for alias, col in GROUP_ALIASES.items() if col in df.columns and col in categorial}
+
+        # Словарь значений категориальных колонок: "austin" -> ("City", "Austin")
+        vocabulary = FILLER_WORDS | TOP_WORDS | BOTTOM_WORDS | DISTRIBUTION_WORDS | set(AGG_WORDS) | set(self.metrics)
+        self.values = {}
+        for col in FILTER_COLUMNS:
+            if col not in df.columns:
+                continue
+            for value in pd.unique(df[col].astype(str)):
+                key = " ".join(tokenize(value))
+                if value == MISSING_VALUE or len(key) < 3 or key in vocabulary:
+                    continue
+                self.values.setdefault(key, (col, value))
+
+    def _match_phrases(self, tokens, phrases, used):
+        # Ищет фразы из словаря (самые длинные первыми) и помечает использованные токены
+        found = []
+        max_len = max((len(phrase.split()) for phrase in phrases), default=1)
+        for length in range(max_len, 0, -1):
+            for start in range(len(tokens) - length + 1):
+                span = range(start, start + length)
+                if any(i in used for i in span):
+                    continue
+                phrase = " ".join(tokens[start:start + length])
+                if phrase in phrases:
+                    found.append((start, phrases[phrase]))
+                    used.update(span)
+        return [item for _, item in sorted(found, key=lambda pair: pair[0])]
+
+    def parse(self, text):
+        tokens = tokenize(text)
+        if not tokens or any(token in ESCALATE_WORDS for token in tokens):
+            return None
+        used = set()
+
+        # Группировка: "by city", "per property type", "for each county"
+        group = None
+        group_phrases = {f"{marker} {alias}": col for marker in GROUP_MARKERS for alias, col in self.groups.items()}
+        groups = self._match_phrases(tokens, group_phrases, used)
+        if len(groups) > 1:
+            return None
+        if groups:
+            group = groups[0]
+
+        filters = self._match_phrases(tokens, self.values, used)
+        bool_filters = self._match_phrases(tokens, self.bools, used)
+        metrics = self._match_phrases(tokens, self.metrics, used)
+        if len(set(metrics)) > 1:
+            return None
+        metric = metrics[0] if metrics else None
+
+        count = False
+        for phrase in COUNT_PHRASES:
+            phrase_tokens = phrase.split()
+            for start in range(len(tokens) - len(phrase_tokens) + 1):
+                if tokens[start:start + len(phrase_tokens)] == phrase_tokens and not used.intersection(range(start, start + len(phrase_tokens))):
+                    count = True
+                    used.update(range(start, start + len(phrase_tokens)))
+
+        intent, stat, ascending, n = None, None, False, None
+        for i, token in enumerate(tokens):
+            if i in used:
+                continue
+            if token in AGG_WORDS:
+                intent, stat = "aggregate", AGG_WORDS[token]
+            elif token in DISTRIBUTION_WORDS:
+                intent = intent or "distribution"
+            elif token in TOP_WORDS:
+                intent = intent or "top"
+            elif token in BOTTOM_WORDS:
+                intent, ascending = intent or "top", True
+                if token == "cheapest" and metric is None:
+                    metric = "Price" if "Price" in self.df.columns else None
+            elif token.isdigit() and n is None:
+                n = int(token)
+            elif token in NUMBER_WORDS and n is None:
+                n = NUMBER_WORDS[token]
+            elif token not in FILLER_WORDS:
+                return None
+            used.add(i)
+
+        if count and intent is None:
+            intent, stat = "aggregate", "count"
+        if intent is None:
+            return None
+        if intent == "top" and group is not None:
+            # "Highest price by city" - экстремум в каждой группе; среднее ("highest average cap rate by city")
+            # считается только при слове-агрегате, и тогда intent уже aggregate
+            intent, stat = "aggregate", "min" if ascending else "max"
+        if metric is None and stat != "count":
+            return None
+        if intent in ("distribution", "aggregate") and n is not None and group is None:
+            return None
+
+        filter_map = {}
+        for col, value in filters:
+            filter_map.setdefault(col, set()).add(value)
+
+        return {
+            "intent": intent,
+            "metric": metric,
+            "stat": stat,
+            "group": group,
+            "filters": filter_map,
+            "bool_filters": bool_filters,
+            "n": min(n, MAX_TOP_N) if n is not None else None,
+            "ascending": ascending,
+        }
+
+    def _mask(self, query):
+        mask = pd.Series(True, index=self.df.index)
+        for col, values in query["filters"].items():
+            mask &= self.df[col].isin(values)
+        for col in query["bool_filters"]:
+            mask &= self.df[col].fillna(False).astype(bool)
+        return mask
+
+    def _describe_filters(self, query):
+        parts = [f"{col} = {', '.join(sorted(values))}" for col, values in query["filters"].items()]
+        parts += [f"{col}" for col in query["bool_filters"]]
+        return f" ({'; '.join(parts)})" if parts else ""
+
+    def _indexed(self, query):
+        # Запросы без фильтров по ранжированным метрикам отвечаем по предрасчитанному индексу
+        return (self.index is not None and not query["filters"] and not query["bool_filters"]
+                and query["metric"] in self.index.sorted)
+
+    def execute(self, query):
+        metric, where = query["metric"], self._describe_filters(query)
+        if query["intent"] == "top" and self._indexed(query):
+            n = query["n"] or DEFAULT_TOP_N
+            table = self.index.top_k(metric, n, ascending=query["ascending"])
+            direction = "lowest" if query["ascending"] else "highest"
+            return (f"Found {len(self.index.sorted[metric][0])} properties with {metric}. "
+                    f"Top {len(table)} by {direction} {metric}:\n\n{table.to_markdown(index=False)}")
+        if query["intent"] == "distribution" and self._indexed(query):
+            summary = self.index.summary(metric).copy()
+            for q in (10, 90):
+                summary[f"{q}%"] = self.index.percentile(metric, q)
+            order = ["count", "mean", "std", "min", "10%", "25%", "50%", "75%", "90%", "max"]
+            return f"Distribution of {metric}:\n\n{summary[order].to_frame(metric).to_markdown()}"
+
+        df = self.df[self._mask(query)]
+        if df.empty:
+            return f"No properties found{where}."
+
+        if query["intent"] == "top":
+            values = df[metric].dropna()
+            n = query["n"] or DEFAULT_TOP_N
+            order = values.nsmallest(n) if query["ascending"] else values.nlargest(n)
+            columns = [col for col in ["Property ID", "Address", "City", "Property Type"] if col in df.columns]
+            table = df.loc[order.index, columns + [metric]]
+            direction = "lowest" if query["ascending"] else "highest"
+            return (f"Found {len(values)} properties with {metric}{where}. "
+                    f"Top {len(table)} by {direction} {metric}:\n\n{table.to_markdown(index=False)}")
+
+        if query["intent"] == "distribution":
+            summary = df[metric].describe(percentiles=[0.1, 0.25, 0.5, 0.75, 0.9]).to_frame(metric)
+            return f"Distribution of {metric}{where}:\n\n{summary.to_markdown()}"
+
+        stat = query["stat"]
+        if query["group"] is not None:
+            grouped = df.groupby(query["group"], observed=True)
+            result = grouped.size() if stat == "count" else grouped[metric].agg(stat)
+            result = result.dropna().sort_values(ascending=query["ascending"])
+            limit = query["n"] or MAX_GROUPS
+            label = "Number of properties" if stat == "count" else f"{stat.capitalize()} {metric}"
+            table = result.head(limit).to_frame(label)
+            return f"{label} by {query['group']}{where}:\n\n{table.to_markdown()}"
+
+        if stat == "count":
+            return f"Number of properties{where}: {len(df)}"
+        value = df[metric].agg(stat)
+        if pd.isna(value):
+            return f"No {metric} data available{where}."
+        return f"{stat.capitalize()} {metric}{where}: {value:,.2f} (based on {df[metric].notna().sum()} properties)"
+
+    def answer(self, text):
+        # Возвращает готовый ответ или None, если вопрос нужно передать агенту
+        query = self.parse(text)
+        response = self.execute(query) if query is not None else None
+        record_hit(response is not None)
+        return response
@@ -0,0 +1,133 @@
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Как часто (в секундах) проверять, не изменились ли источники ресурсов
+CHECK_INTERVAL = 2.0
+
+
+def estimate_memory(value):
+    # Приблизительный объём памяти ресурса в байтах
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True, index=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True, index=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if sparse.issparse(value):
+        return int(sum(getattr(value, name).nbytes for name in ("data", "indices", "indptr") if hasattr(value, name)))
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_memory(item) for item in value)
+    if isinstance(value, dict):
+        return sum(estimate_memory(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+class _Entry:
+    def __init__(self, build, fingerprint, memory, dispose, live_memory, refresh):
+        self.build = build
+        self.refresh = refresh
+        self.fingerprint = fingerprint
+        self.memory = memory
+        self.dispose = dispose
+        self.live_memory = live_memory
+        self.memory_bytes = 0
+        self.value = None
+        self.version = None
+        self.checked_at = 0.0
+        self.built_at = None
+        self.build_seconds = None
+        self.builds = 0
+        self.refreshes = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+
+class ResourceRegistry:
+    # Реестр тяжёлых объектов (данные, индексы, агент), которые строятся один раз на процесс
+    # и разделяются всеми сессиями Streamlit только для чтения.
+    # При изменении источника (fingerprint) ресурс перестраивается в фоне запроса и подменяется атомарно:
+    # те, кто уже получил старый объект, дорабатывают с ним.
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, build, fingerprint, memory=estimate_memory, dispose=None, live_memory=False, refresh=None):
+        # dispose вызывается для старого объекта после подмены (например, чтобы остановить пул процессов).
+        # refresh(старый объект) - дешёвое обновление вместо build; если оно невозможно, возвращает None.
+        # Объём памяти считается один раз при сборке; live_memory=True - при каждом stats() для ресурсов,
+        # которые растут после сборки и умеют дёшево сообщать свой размер (кэши)
+        with self._lock:
+            self._entries[name] = _Entry(build, fingerprint, memory, dispose, live_memory, refresh)
+
+    def get(self, name):
+        entry = self._entries[name]
+        now = time.monotonic()
+        if entry.value is not None and now - entry.checked_at < self.check_interval:
+            return entry.value
+
+        with entry.lock:
+            if entry.value is not None and time.monotonic() - entry.checked_at < self.check_interval:
+                return entry.value
+            version = entry.fingerprint()
+            if entry.value is None or version != entry.version:
+                started = time.perf_counter()
+                try:
+                    value = None
+                    if entry.value is not None and entry.refresh is not None:
+                        value = entry.refresh(entry.value)
+                        entry.refreshes += value is not None
+                    if value is None:
+                        value = entry.build()
+                except Exception as e:
+                    entry.error = str(e)
+                    # Если перестроить не удалось, продолжаем отдавать прежнюю версию
+                    if entry.value is None:
+                        raise
+                    print(f"Failed to rebuild resource '{name}': {e}")
+                    entry.checked_at = time.monotonic()
+                    return entry.value
+                entry.build_seconds = time.perf_counter() - started
+                entry.memory_bytes = entry.memory(value)
+                entry.built_at = time.time()
+                entry.builds += 1
+                entry.error = None
+                previous = entry.value
+                entry.value, entry.version = value, version
+                if previous is not None and entry.dispose is not None:
+                    entry.dispose(previous)
+            entry.checked_at = time.monotonic()
+            return entry.value
+
+    def version(self, name):
+        self.get(name)
+        return self._entries[name].version
+
+    def invalidate(self, name=None):
+        names = [name] if name else list(self._entries)
+        for key in names:
+            entry = self._entries[key]
+            with entry.lock:
+                entry.version = None
+                entry.checked_at = 0.0
+
+    def stats(self):
+        result = {}
+        for name, entry in list(self._entries.items()):
+            result[name] = {
+                "loaded": entry.value is not None,
+                "version": entry.version,
+                "builds": entry.builds,
+                "refreshes": entry.refreshes,
+                "build_seconds": entry.build_seconds,
+                "built_at": entry.built_at,
+                "memory_bytes": entry.memory(entry.value) if entry.live_memory and entry.value is not None else entry.memory_bytes,
+                "error": entry.error,
+            }
+        return result
@@ -0,0 +1,135 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Кэш ответов агента: точное совпадение по нормализованному запросу или почти-дубликат - запрос с той же
+# последовательностью значимых слов. Ограничен по числу записей (LRU) и по времени жизни (TTL),
+# сбрасывается при изменении содержимого df.csv.
+
+MAX_ENTRIES = 512
+TTL_SECONDS = 6 * 60 * 60
+
+# Слова, которые не меняют смысл запроса: артикли, вежливые обращения и связки. Список намеренно короткий -
+# в общих списках стоп-слов есть up/down, back/front, fifteen/fifty, between, only, all, которые меняют ответ
+NEUTRAL_WORDS = {
+    "a", "an", "the", "please", "show", "me", "us", "give", "list", "display", "tell", "find", "can", "could",
+    "would", "you", "i", "we", "want", "need", "to", "see", "get", "some", "any", "is", "are", "was",
+    "were", "be", "of", "for", "what", "which", "there", "do", "does", "kindly", "just",
+}
+
+
+def normalize_query(query):
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def query_signature(key):
+    # Значимые слова в исходном порядке: "rent higher than price" и "price higher than rent" различаются,
+    # а "show the top 5 condos" и "show top 5 condos" совпадают
+    return " ".join(word for word in key.split() if word not in NEUTRAL_WORDS)
+
+
+class ResponseCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.dataset_version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ключ -> (ответ, PNG графика или None, время создания)
+        self._lock = threading.Lock()
+        self._signatures = {}  # сигнатура -> ключ последней записи с ней
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, plot BLOB, created REAL, version TEXT)"
+            )
+            self._db.commit()
+
+    def _set_version(self, version):
+        # При смене версии данных все ответы устаревают; с диска подгружаем записи текущей версии
+        if version == self.dataset_version:
+            return
+        self.dataset_version = version
+        self._entries.clear()
+        self._signatures.clear()
+        if self._db is None:
+            return
+        self._db.execute("DELETE FROM responses WHERE version != ? OR created < ?", (version, time.time() - self.ttl))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, response, plot, created FROM responses ORDER BY created DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        for key, response, plot, created in reversed(rows):
+            self._entries[key] = (response, plot, created)
+            self._signatures[query_signature(key)] = key
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        signature = query_signature(key)
+        if self._signatures.get(signature) == key:
+            del self._signatures[signature]
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _similar_key(self, key):
+        # Запросы могут отличаться только нейтральными стоп-словами; "Austin"/"Dallas", "top 5"/"top 10"
+        # и перестановка значимых слов дают разные ответы
+        signature = query_signature(key)
+        return self._signatures.get(signature) if signature else None
+
+    def get(self, query, dataset_version):
+        key = normalize_query(query)
+        with self._lock:
+            self._set_version(dataset_version)
+            if key not in self._entries:
+                key = self._similar_key(key)
+            entry = self._entries.get(key) if key is not None else None
+            if entry is not None and time.time() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, query, dataset_version, response, plot=None):
+        key = normalize_query(query)
+        created = time.time()
+        with self._lock:
+            self._set_version(dataset_version)
+            self._entries[key] = (response, plot, created)
+            self._signatures[query_signature(key)] = key
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, plot, created, version) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, plot, created, dataset_version),
+                )
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._signatures.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
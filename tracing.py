@@ -0,0 +1,356 @@
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Трассировка этапов обработки запроса. Спаны копятся в памяти (запись - одно добавление в deque),
+# а фоновый поток пачками сбрасывает их в MLflow, файл JSON Lines или Prometheus.
+# На пути запроса нет обращений к трекинг-серверу; гистограммы задержек и стоимость LLM считаются по маршрутам.
+
+TRACE_EXPORTERS = os.getenv("TRACE_EXPORTERS", "mlflow")  # через запятую: mlflow, file, prometheus или none
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "10"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "500"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100000"))
+TRACE_FILE = os.getenv("TRACE_FILE", ".cache/traces.jsonl")
+PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "9464"))
+# Цены gpt-4-turbo за 1000 токенов, USD
+PROMPT_PRICE_PER_1K = float(os.getenv("LLM_PROMPT_PRICE_PER_1K", "0.01"))
+COMPLETION_PRICE_PER_1K = float(os.getenv("LLM_COMPLETION_PRICE_PER_1K", "0.03"))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+MLFLOW_BATCH_LIMIT = 1000
+PENDING_TRACE_TIMEOUT = 600  # спаны трассы, которую так и не завершили, сбрасываются через столько секунд
+
+
+def llm_cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * PROMPT_PRICE_PER_1K + completion_tokens * COMPLETION_PRICE_PER_1K) / 1000
+
+
+class LatencyHistogram:
+    # Фиксированные корзины в миллисекундах; перцентили оцениваются верхней границей корзины
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            position = len(self.buckets)
+        self.counts[position] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[position], self.max) if position < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class Trace:
+    # Один запрос пользователя. Маршрут (faq, support, fast_path, cache, agent, plot, error) выставляется по ходу
+    # обработки; спаны незавершённой трассы ждут её завершения, чтобы попасть в итоговый маршрут
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.id = uuid.uuid4().hex[:16]
+        self.route = "unknown"
+        self.attrs = {}
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.finished = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def add_span(self, name, started_at, duration_ms, attrs=None):
+        self.tracer.record((self, name, started_at, duration_ms, attrs or {}))
+
+    def finish(self):
+        # Спан "total" - полное время запроса от создания трассы
+        if not self.finished:
+            self.finished = True
+            self.add_span("total", self.started_at, (time.perf_counter() - self.started) * 1000)
+
+
+class Span:
+    # with trace.span("faq_match") as attrs: ... - в attrs можно дописать атрибуты спана
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        return self.attrs
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add_span(self.name, self.started_at, (time.perf_counter() - self.started) * 1000, self.attrs)
+        return False
+
+
+def token_usage(response):
+    # При потоковой выдаче счётчики приходят в usage_metadata сообщения (stream_usage=True), иначе - в llm_output
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    # Спаны вызовов LLM (с числом токенов) и инструментов агента; ошибки трассировки не прерывают запрос
+    def __init__(self, trace):
+        self.trace = trace
+        self.started = {}
+
+    def _start(self, run_id, name):
+        self.started[run_id] = (name, time.time(), time.perf_counter())
+
+    def _end(self, run_id, span_name, **attrs):
+        if (started := self.started.pop(run_id, None)) is None:
+            return
+        name, started_at, started_perf = started
+        if name:
+            attrs["name"] = name
+        self.trace.add_span(span_name, started_at, (time.perf_counter() - started_perf) * 1000, attrs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, None)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens, completion_tokens = token_usage(response)
+        self._end(run_id, "llm", prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "llm", error=type(error).__name__)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, (serialized or {}).get("name"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id, "tool")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "tool", error=type(error).__name__)
+
+
+class Tracer:
+    def __init__(self, exporters=(), flush_interval=TRACE_FLUSH_INTERVAL, batch_size=TRACE_BATCH_SIZE,
+                 buffer_size=TRACE_BUFFER_SIZE):
+        self.exporters = list(exporters)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # При переполнении (экспорт не успевает) теряются самые старые спаны, запросы не ждут
+        self._buffer = deque(maxlen=buffer_size)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        self._pending = []
+        self.histograms = {}  # (маршрут, спан) -> LatencyHistogram
+        self.costs = {}  # маршрут -> {"prompt_tokens", "completion_tokens", "cost_usd"}
+        self.gauges = {}
+        self.dropped = 0
+        atexit.register(self.flush)
+
+    def start_trace(self):
+        return Trace(self)
+
+    def record(self, span):
+        if self._thread is None:
+            self._start()
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append(span)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tracing-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            spans, self._pending = self._pending, []
+            while self._buffer:
+                spans.append(self._buffer.popleft())
+            stale = time.time() - PENDING_TRACE_TIMEOUT
+            ready = []
+            for span in spans:
+                trace = span[0]
+                (ready if trace.finished or trace.started_at < stale else self._pending).append(span)
+            spans = ready
+            if not spans:
+                return
+            with self._stats_lock:
+                records = self._aggregate(spans)
+            for exporter in self.exporters:
+                try:
+                    exporter.export(records, self)
+                except Exception as e:
+                    print(f"Failed to export {len(records)} spans to {type(exporter).__name__}: {e}")
+
+    def _aggregate(self, spans):
+        records = []
+        for trace, name, started_at, duration_ms, attrs in spans:
+            record = {"trace_id": trace.id, "route": trace.route, "span": name, "start": started_at,
+                      "duration_ms": duration_ms, **attrs}
+            if name == "total":
+                record.update(trace.attrs)
+            records.append(record)
+            self.histograms.setdefault((trace.route, name), LatencyHistogram()).observe(duration_ms)
+            if "prompt_tokens" in attrs:
+                record["cost_usd"] = llm_cost(attrs["prompt_tokens"], attrs["completion_tokens"])
+                cost = self.costs.setdefault(trace.route, {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+                cost["prompt_tokens"] += attrs["prompt_tokens"]
+                cost["completion_tokens"] += attrs["completion_tokens"]
+                cost["cost_usd"] += record["cost_usd"]
+        return records
+
+    def stats(self):
+        # {маршрут: {"spans": {спан: сводка гистограммы}, "cost_usd", "prompt_tokens", "completion_tokens"}}
+        routes = {}
+        with self._stats_lock:
+            for (route, name), histogram in sorted(self.histograms.items()):
+                routes.setdefault(route, {"spans": {}, **self.costs.get(route, {})})["spans"][name] = histogram.summary()
+        return routes
+
+
+class FileExporter:
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+
+    def export(self, records, tracer):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+class MlflowExporter:
+    # Один долгоживущий запуск на процесс: длительности спанов - метрики с шагом, сводки гистограмм
+    # и стоимость - накопленные метрики, сами записи - артефакт JSON Lines на каждый сброс
+    def __init__(self, experiment_name=None):
+        self.experiment_name = experiment_name or os.getenv("MLFLOW_EXPERIMENT_NAME", "Default")
+        self.client = None
+        self.run_id = None
+        self.steps = {}
+
+    def _ensure_run(self):
+        if self.run_id is None:
+            from mlflow import MlflowClient
+
+            self.client = MlflowClient()
+            experiment = self.client.get_experiment_by_name(self.experiment_name)
+            experiment_id = experiment.experiment_id if experiment else self.client.create_experiment(self.experiment_name)
+            run_name = f"tracing-{socket.gethostname()}-{os.getpid()}"
+            self.run_id = self.client.create_run(experiment_id, run_name=run_name).info.run_id
+
+    def _step(self, key):
+        self.steps[key] = self.steps.get(key, -1) + 1
+        return self.steps[key]
+
+    def export(self, records, tracer):
+        from mlflow.entities import Metric
+
+        self._ensure_run()
+        now = int(time.time() * 1000)
+        metrics = [
+            Metric(f"{r['route']}/{r['span']}_ms", r["duration_ms"], int(r["start"] * 1000), self._step(f"{r['route']}/{r['span']}"))
+            for r in records
+        ]
+        for (route, name), histogram in tracer.histograms.items():
+            for key, value in histogram.summary().items():
+                metrics.append(Metric(f"{route}/{name}_{key}", value, now, self._step(f"{route}/{name}_{key}")))
+        for route, cost in tracer.costs.items():
+            for key, value in cost.items():
+                metrics.append(Metric(f"{route}/{key}", value, now, self._step(f"{route}/{key}")))
+        for key, value in {**tracer.gauges, "tracing/dropped_spans": tracer.dropped}.items():
+            metrics.append(Metric(key, value, now, self._step(key)))
+        for start in range(0, len(metrics), MLFLOW_BATCH_LIMIT):
+            self.client.log_batch(self.run_id, metrics=metrics[start:start + MLFLOW_BATCH_LIMIT])
+        lines = "\n".join(json.dumps(record, default=str) for record in records)
+        self.client.log_text(self.run_id, lines, f"traces/{now}.jsonl")
+
+
+class PrometheusExporter:
+    # Гистограммы и счётчики prometheus_client на /metrics; без пакета экспортёр отключается
+    def __init__(self, port=PROMETHEUS_PORT):
+        from prometheus_client import Counter, Histogram, start_http_server
+
+        self.latency = Histogram("chatbot_span_latency_seconds", "Latency of request stages", ["route", "span"],
+                                 buckets=[bound / 1000 for bound in LATENCY_BUCKETS_MS])
+        self.tokens = Counter("chatbot_llm_tokens", "LLM tokens", ["route", "kind"])
+        self.cost = Counter("chatbot_llm_cost_usd", "LLM cost in USD", ["route"])
+        start_http_server(port)
+
+    def export(self, records, tracer):
+        for record in records:
+            self.latency.labels(record["route"], record["span"]).observe(record["duration_ms"] / 1000)
+            if "cost_usd" in record:
+                self.tokens.labels(record["route"], "prompt").inc(record["prompt_tokens"])
+                self.tokens.labels(record["route"], "completion").inc(record["completion_tokens"])
+                self.cost.labels(record["route"]).inc(record["cost_usd"])
+
+
+def make_exporters(names=TRACE_EXPORTERS):
+    factories = {"mlflow": MlflowExporter, "file": FileExporter, "prometheus": PrometheusExporter}
+    exporters = []
+    for name in (name.strip() for name in names.split(",")):
+        if name in ("", "none"):
+            continue
+        try:
+            exporters.append(factories[name]())
+        except KeyError:
+            print(f"Unknown trace exporter '{name}'")
+        except (ImportError, OSError) as e:
+            print(f"Trace exporter '{name}' is disabled: {e}")
+    return exporters